@@ -7,13 +7,25 @@
 from __future__ import annotations
 import streamlit as st
 import pandas as pd
+import numpy as np
 from pathlib import Path
 from datetime import datetime, timedelta, date
 import sqlite3
+import threading
+import queue
+import calendar
+from bisect import insort
+from collections import deque
+from contextlib import contextmanager
 from io import BytesIO
+import xlsxwriter
 
 DB_PATH = Path("sala_leitura.db")
 
+# Exportações em xlsxwriter (requirements.txt); openpyxl fica só para ler as planilhas importadas.
+# constant_memory: cada linha vai para o arquivo ao ser escrita (memória plana)
+XLSX_OPCOES = {"constant_memory": True, "strings_to_urls": False}
+
 # ---------------- Campos padrão ----------------
 COLS_MOV = [
     "timestamp","data","hora","tipo",           # Emprestimo, Devolucao
@@ -34,17 +46,145 @@ COLS_ITENS = [
 
 COLS_ALUNOS = ["nome","sobrenome","serie"]
 
+# Histórico da Consulta: linhas enviadas ao navegador por vez ("Mostrar mais" soma outro bloco)
+HIST_LINHAS = 500
+# Tabelas de saldos/catálogo: linhas por página
+LINHAS_POR_PAGINA = 100
+
 # ---------------- SQLite helpers ----------------
 
+def _contem(texto, termo) -> int:
+    """contem(texto, termo) no SQL: substring sem diferenciar maiúsculas (como o filtro da Consulta)."""
+    return int(texto is not None and termo.casefold() in texto.casefold())
+
+def _abre_conn(**kw) -> sqlite3.Connection:
+    con = sqlite3.connect(DB_PATH, check_same_thread=False, **kw)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA cache_size=-64000")      # ~64 MB de page cache (conexão é longa)
+    con.execute("PRAGMA mmap_size=268435456")    # leituras via mmap (até 256 MB)
+    con.execute("PRAGMA analysis_limit=1000")     # optimize/ANALYZE amostram, não leem tudo
+    con.create_function("contem", 2, _contem, deterministic=True)
+    return con
+
+@st.cache_resource(show_spinner=False)
 def get_conn():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
-
-def _table_has_column(con, table, column):
-    cur = con.execute(f"PRAGMA table_info({table})")
-    cols = [r[1] for r in cur.fetchall()]  # name is index 1
-    return column in cols
+    """Conexão de escrita única por processo, compartilhada por todas as sessões (threads).
+       O commit/rollback de `with get_conn() as con:` vale para a conexão inteira, não só
+       para o bloco: use sempre `with trava_escrita(), get_conn() as con:`. Leituras vão
+       por conn_leitura()."""
+    return _abre_conn()
+
+# conexões de leitura ociosas guardadas no pool; as de um pico acima disso são fechadas
+# na devolução (cada uma tem seu page cache e mmap)
+POOL_LEITURA = 4
+
+@st.cache_resource(show_spinner=False)
+def _conns_leitura() -> queue.Queue:
+    return queue.Queue(maxsize=POOL_LEITURA)
+
+@contextmanager
+def conn_leitura():
+    """Conexão só de leitura emprestada de um pool (uma por leitura simultânea; até
+       POOL_LEITURA ficam abertas entre leituras).
+       Em WAL cada SELECT enxerga apenas transações já confirmadas, e nada aqui faz
+       commit/rollback: a transação de um escritor na conexão compartilhada fica intacta."""
+    livres = _conns_leitura()
+    try:
+        con = livres.get_nowait()
+    except queue.Empty:
+        con = _abre_conn(isolation_level=None)
+        con.execute("PRAGMA query_only=1")
+    try:
+        yield con
+    finally:
+        try:
+            livres.put_nowait(con)
+        except queue.Full:
+            con.close()
+
+@st.cache_resource(show_spinner=False)
+def trava_escrita() -> threading.Lock:
+    """Um escritor por vez na conexão compartilhada: as sessões do Streamlit rodam em threads,
+       e sem isso o commit de uma sessão levaria junto a transação pela metade de outra.
+       Leituras não passam por essa conexão (ver conn_leitura)."""
+    return threading.Lock()
+
+# commits de escrita entre dois PRAGMA optimize (a conexão vive o processo todo)
+OTIMIZA_A_CADA = 200
+
+@st.cache_resource(show_spinner=False)
+def _commits() -> dict:
+    return {"n": 0}
+
+def commit_escrita(con):
+    """commit() dos escritores (sob trava_escrita). A cada OTIMIZA_A_CADA commits roda
+       PRAGMA optimize, que só reanalisa tabelas cujas estatísticas ficaram defasadas."""
+    con.commit()
+    cont = _commits()
+    cont["n"] += 1
+    if cont["n"] % OTIMIZA_A_CADA == 0:
+        con.execute("PRAGMA optimize")
+
+def versao_db() -> tuple[int, int]:
+    """Marca de modificação do banco para chavear caches longos. Em WAL os commits só chegam
+       ao arquivo principal no checkpoint, então o mtime do -wal entra na chave."""
+    wal = DB_PATH.with_name(DB_PATH.name + "-wal")
+    return (DB_PATH.stat().st_mtime_ns, wal.stat().st_mtime_ns if wal.exists() else 0)
+
+def _colunas(con, table) -> set[str]:
+    """Nomes das colunas de `table` (um único PRAGMA table_info por tabela)."""
+    return {r[1] for r in con.execute(f"PRAGMA table_info({table})")}  # name is index 1
+
+# Último movimento por item, materializado (item_nome -> id do movimento) e mantido por
+# gatilhos: status_itens lê O(itens) em vez de varrer o índice de movimentacoes.
+# Desempate igual ao ORDER BY timestamp DESC, id DESC (NULL conta como o menor timestamp).
+SQL_ULTIMO_MOV = """
+CREATE TABLE IF NOT EXISTS ultimo_mov (
+    item_nome TEXT PRIMARY KEY,
+    mov_id INTEGER NOT NULL,
+    timestamp TEXT
+);
+CREATE TRIGGER IF NOT EXISTS ultimo_mov_ai AFTER INSERT ON movimentacoes
+WHEN new.item_nome IS NOT NULL BEGIN
+    INSERT INTO ultimo_mov(item_nome, mov_id, timestamp) VALUES (new.item_nome, new.id, new.timestamp)
+    ON CONFLICT(item_nome) DO UPDATE SET mov_id = excluded.mov_id, timestamp = excluded.timestamp
+     WHERE (IFNULL(excluded.timestamp, ''), excluded.mov_id) > (IFNULL(ultimo_mov.timestamp, ''), ultimo_mov.mov_id);
+END;
+CREATE TRIGGER IF NOT EXISTS ultimo_mov_ad AFTER DELETE ON movimentacoes
+WHEN old.id IN (SELECT mov_id FROM ultimo_mov WHERE item_nome = old.item_nome) BEGIN
+    DELETE FROM ultimo_mov WHERE item_nome = old.item_nome;
+    INSERT INTO ultimo_mov(item_nome, mov_id, timestamp)
+    SELECT item_nome, id, timestamp FROM movimentacoes WHERE item_nome = old.item_nome
+     ORDER BY timestamp DESC, id DESC LIMIT 1;
+END;
+CREATE TRIGGER IF NOT EXISTS ultimo_mov_au AFTER UPDATE OF item_nome, timestamp ON movimentacoes BEGIN
+    DELETE FROM ultimo_mov WHERE item_nome IN (old.item_nome, new.item_nome);
+    INSERT INTO ultimo_mov(item_nome, mov_id, timestamp)
+    SELECT item_nome, id, timestamp FROM movimentacoes WHERE item_nome = old.item_nome
+     ORDER BY timestamp DESC, id DESC LIMIT 1;
+    INSERT OR IGNORE INTO ultimo_mov(item_nome, mov_id, timestamp)
+    SELECT item_nome, id, timestamp FROM movimentacoes WHERE item_nome = new.item_nome
+     ORDER BY timestamp DESC, id DESC LIMIT 1;
+END;
+"""
+
+SQL_ADD_TS_US = """
+ALTER TABLE movimentacoes ADD COLUMN ts_us INTEGER
+    GENERATED ALWAYS AS (CAST(strftime('%s', timestamp) AS INTEGER) * 1000000) VIRTUAL
+"""
+
+def _tenta(con, sql: str) -> bool:
+    """Executa `sql`; False se o SQLite recusar (recurso ausente na versão instalada)."""
+    try:
+        con.execute(sql)
+        return True
+    except sqlite3.OperationalError:
+        return False
 
 def init_db():
+    """Schema, migrações de colunas, índices e tabelas auxiliares. Roda sob trava_escrita (ensure_migrations)."""
     with get_conn() as con:
         cur = con.cursor()
         # movimentacoes
@@ -102,23 +242,67 @@ def init_db():
         )
         con.commit()
 
-        # Migrações leves (garantia de colunas)
+        # Migrações leves (garantia de colunas): lê o schema uma vez e só altera o que falta
+        existentes = _colunas(con, "movimentacoes")
         for col, ddl in [
             ("quantidade", "INTEGER DEFAULT 1"),
             ("beneficiario_tipo", "TEXT DEFAULT ''"),
             ("beneficiario_nome", "TEXT DEFAULT ''"),
             ("loan_id", "INTEGER"),
         ]:
-            if not _table_has_column(con, "movimentacoes", col):
+            if col not in existentes:
                 con.execute(f"ALTER TABLE movimentacoes ADD COLUMN {col} {ddl}")
+        existentes = _colunas(con, "itens")
         for col, ddl in [
             ("titulo","TEXT"),("autor","TEXT"),("editora","TEXT"),("genero","TEXT"),
             ("isbn","TEXT"),("edicao","TEXT"),("quant_total","INTEGER DEFAULT 1"),
         ]:
-            if not _table_has_column(con, "itens", col):
+            if col not in existentes:
                 con.execute(f"ALTER TABLE itens ADD COLUMN {col} {ddl}")
+
+        # ts_us: timestamp em µs desde a época (coluna gerada, sempre em dia com `timestamp`)
+        # para filtros de período por inteiro. SQLite < 3.31 não tem colunas geradas: nesse caso
+        # o período segue comparando o TEXT ISO via idx_mov_ts.
+        tem_ts = _tenta(con, "SELECT ts_us FROM movimentacoes LIMIT 0") or _tenta(con, SQL_ADD_TS_US)
+
+        # Índices (último movimento por item, filtros por período)
+        con.execute("CREATE INDEX IF NOT EXISTS idx_mov_item_ts ON movimentacoes(item_nome, timestamp DESC)")
+        if tem_ts:
+            con.execute("CREATE INDEX IF NOT EXISTS idx_mov_ts_us ON movimentacoes(ts_us)")
+            con.execute("DROP INDEX IF EXISTS idx_mov_ts")
+        else:
+            con.execute("CREATE INDEX IF NOT EXISTS idx_mov_ts ON movimentacoes(timestamp)")
+        # loan_id: devoluções por empréstimo e a checagem "há linhas sem vínculo?" da migração
+        con.execute("CREATE INDEX IF NOT EXISTS idx_mov_loan ON movimentacoes(loan_id)")
+        # Chaves do upsert do catálogo (isbn; titulo+autor+edição). item_nome já é UNIQUE,
+        # assim como (nome, sobrenome, serie) em alunos.
+        con.execute("CREATE INDEX IF NOT EXISTS idx_itens_isbn ON itens(isbn)")
+        con.execute("CREATE INDEX IF NOT EXISTS idx_itens_chave ON itens(titulo, autor, IFNULL(edicao, ''))")
+        con.commit()
+
+        # Último movimento por item (tabela nova sobre histórico existente: carga única)
+        novo_ultimo = con.execute("SELECT 1 FROM sqlite_master WHERE name='ultimo_mov'").fetchone() is None
+        con.executescript(SQL_ULTIMO_MOV)
+        if novo_ultimo:
+            con.execute("""
+                INSERT INTO ultimo_mov(item_nome, mov_id, timestamp)
+                SELECT item_nome, id, timestamp FROM (
+                    SELECT item_nome, id, timestamp,
+                           ROW_NUMBER() OVER (PARTITION BY item_nome ORDER BY timestamp DESC, id DESC) AS rn
+                      FROM movimentacoes WHERE item_nome IS NOT NULL)
+                 WHERE rn = 1
+            """)
         con.commit()
 
+@st.cache_resource(show_spinner=False)
+def tem_ts_us() -> bool:
+    with conn_leitura() as con:
+        return _tenta(con, "SELECT ts_us FROM movimentacoes LIMIT 0")
+
+def _epoch_us(iso: str) -> int:
+    """ISO-8601 (sem fuso) -> µs desde a época, na mesma convenção de strftime('%s') do SQLite."""
+    return calendar.timegm(datetime.fromisoformat(iso).timetuple()) * 1_000_000
+
 def _benef_key(row: pd.Series) -> tuple:
     """Chave do beneficiário para casar devoluções antigas com empréstimos."""
     bt = (row.get("beneficiario_tipo") or "").strip().lower()
@@ -130,11 +314,23 @@ def _benef_key(row: pd.Series) -> tuple:
             (row.get("aluno_sobrenome") or "").strip(),
             (row.get("aluno_serie") or "").strip())
 
+def _chaves_fifo(df: pd.DataFrame) -> pd.Series:
+    """(item, _benef_key) de cada linha como uma string (campos unidos por \x1f), numa
+       passada vetorizada: é a chave das filas FIFO da migração de devoluções."""
+    def campo(c):
+        return df[c].fillna("").astype(str).str.strip()
+    prof = campo("beneficiario_tipo").str.lower().eq("professor")
+    benef = np.where(prof, "professor\x1f" + campo("beneficiario_nome"),
+                     "aluno\x1f" + campo("aluno_nome") + "\x1f" + campo("aluno_sobrenome") + "\x1f" + campo("aluno_serie"))
+    return campo("item_nome") + "\x1e" + benef
+
 def migrate_link_old_returns():
-    """Vincula loan_id dos empréstimos e tenta associar devoluções antigas (sem loan_id) ao(s) empréstimo(s) corretos (FIFO)."""
+    """Vincula loan_id dos empréstimos e tenta associar devoluções antigas (sem loan_id) ao(s) empréstimo(s) corretos (FIFO).
+       Roda sob trava_escrita (ensure_migrations)."""
     with get_conn() as con:
-        con.row_factory = sqlite3.Row
-
+        # nada sem loan_id (o caso comum depois da primeira migração): nem UPDATE nem leituras
+        if con.execute("SELECT 1 FROM movimentacoes WHERE loan_id IS NULL OR loan_id = 0 LIMIT 1").fetchone() is None:
+            return
         # 1) loan_id = id para todas as linhas de tipo Emprestimo sem loan_id
         con.execute("""
             UPDATE movimentacoes
@@ -161,16 +357,18 @@ def migrate_link_old_returns():
              WHERE lower(tipo) LIKE 'devolu%' AND loan_id IS NOT NULL
              GROUP BY loan_id
         """, con)
-        linked_map = {int(r["loan_id"]): int(r["q"]) for _, r in df_devs_linked.iterrows()} if not df_devs_linked.empty else {}
+        linked_map = dict(zip(df_devs_linked["loan_id"].astype(int), df_devs_linked["q"].fillna(0).astype(int)))
 
         # constrói estrutura FIFO por (item, beneficiario)
-        fifo = {}  # key -> list of dicts {id, disponivel}
-        for _, e in df_emp.iterrows():
-            key = ( (e["item_nome"] or "").strip(), _benef_key(e) )
-            disponivel = int(e["quantidade"] or 0) - int(linked_map.get(int(e["id"]), 0))
-            if disponivel <= 0:
-                continue
-            fifo.setdefault(key, []).append({"id": int(e["id"]), "disponivel": disponivel})
+        df_emp["chave"] = _chaves_fifo(df_emp)
+        df_emp["disp"] = (df_emp["quantidade"].fillna(0).astype(int)
+                          - df_emp["id"].map(linked_map).fillna(0).astype(int))
+        # key -> deque de {id, disponivel} na ordem do empréstimo (groupby mantém a ordem das linhas)
+        abertos = df_emp.loc[df_emp["disp"] > 0, ["id", "chave", "disp"]]
+        fifo = {
+            k: deque({"id": int(i), "disponivel": int(q)} for i, q in zip(g["id"], g["disp"]))
+            for k, g in abertos.groupby("chave", sort=False)
+        }
 
         # 3) Processa devoluções SEM loan_id
         df_dev = pd.read_sql_query("""
@@ -183,77 +381,203 @@ def migrate_link_old_returns():
              ORDER BY datetime(timestamp)
         """, con)
 
-        for _, d in df_dev.iterrows():
-            key = ( (d["item_nome"] or "").strip(), _benef_key(d) )
-            fila = fifo.get(key, [])
+        # escritas acumuladas e aplicadas em lote no fim (um executemany por tipo de comando)
+        novas, apagar, atualizar = [], [], []
+        df_dev["chave"] = _chaves_fifo(df_dev)
+        for d in df_dev.itertuples(index=False):
+            fila = fifo.get(d.chave)
             if not fila:
-                # Não achou empréstimo correspondente — mantém sem loan_id
+                # Não achou empréstimo com saldo — mantém sem loan_id
                 continue
-            restante = int(d["quantidade"] or 0)
+            restante = int(d.quantidade or 0)
             # vamos fatiar se necessário: criar novas devoluções coladas com loan_id
-            for bucket in fila:
-                if restante <= 0:
-                    break
-                if bucket["disponivel"] <= 0:
-                    continue
+            # buckets esgotados saem da frente da fila; o próximo é sempre fila[0]
+            while restante > 0 and fila:
+                bucket = fila[0]
                 aloca = min(restante, bucket["disponivel"])
-                # cria nova linha de devolução vinculada
-                con.execute("""
-                    INSERT INTO movimentacoes (
-                        timestamp, data, hora, tipo, item_nome, categoria,
-                        aluno_nome, aluno_sobrenome, aluno_serie, responsavel,
-                        prev_devolucao, observacoes, quantidade,
-                        beneficiario_tipo, beneficiario_nome, loan_id
-                    ) VALUES (?, ?, ?, 'Devolucao', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    d["timestamp"], d["data"], d["hora"], d["item_nome"], d["categoria"],
-                    d["aluno_nome"], d["aluno_sobrenome"], d["aluno_serie"], d["responsavel"],
-                    d["prev_devolucao"], d["observacoes"], int(aloca),
-                    d["beneficiario_tipo"], d["beneficiario_nome"], int(bucket["id"])
+                # nova linha de devolução vinculada
+                novas.append((
+                    d.timestamp, d.data, d.hora, d.item_nome, d.categoria,
+                    d.aluno_nome, d.aluno_sobrenome, d.aluno_serie, d.responsavel,
+                    d.prev_devolucao, d.observacoes, int(aloca),
+                    d.beneficiario_tipo, d.beneficiario_nome, int(bucket["id"])
                 ))
                 bucket["disponivel"] -= aloca
                 restante -= aloca
+                if bucket["disponivel"] <= 0:
+                    fila.popleft()
 
             if restante <= 0:
                 # Remove a devolução antiga original (não vinculada)
-                con.execute("DELETE FROM movimentacoes WHERE id = ?", (int(d["id"]),))
+                apagar.append((int(d.id),))
             else:
                 # Atualiza a devolução original com o que sobrou (sem loan_id mesmo)
-                con.execute("UPDATE movimentacoes SET quantidade=? WHERE id=?", (int(restante), int(d["id"])))
+                atualizar.append((int(restante), int(d.id)))
 
+        con.executemany("""
+            INSERT INTO movimentacoes (
+                timestamp, data, hora, tipo, item_nome, categoria,
+                aluno_nome, aluno_sobrenome, aluno_serie, responsavel,
+                prev_devolucao, observacoes, quantidade,
+                beneficiario_tipo, beneficiario_nome, loan_id
+            ) VALUES (?, ?, ?, 'Devolucao', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, novas)
+        con.executemany("DELETE FROM movimentacoes WHERE id = ?", apagar)
+        con.executemany("UPDATE movimentacoes SET quantidade=? WHERE id=?", atualizar)
         con.commit()
 
-def ensure_migrations():
-    init_db()
-    migrate_link_old_returns()
-
-@st.cache_data(ttl=5)
-def df_mov() -> pd.DataFrame:
-    ensure_migrations()
-    with get_conn() as con:
-        df = pd.read_sql_query(
-            "SELECT timestamp,data,hora,tipo,item_nome,categoria,aluno_nome,aluno_sobrenome,aluno_serie,"
-            "responsavel,prev_devolucao,observacoes,quantidade,beneficiario_tipo,beneficiario_nome,loan_id "
-            "FROM movimentacoes",
-            con,
-        )
+@st.cache_resource(show_spinner=False)
+def ensure_migrations() -> bool:
+    """Cria/migra o schema uma única vez por processo (não roda a cada rerun)."""
+    with trava_escrita():
+        init_db()
+        migrate_link_old_returns()
+    # estatísticas do planejador: ANALYZE na primeira carga (sem sqlite_stat1), depois só optimize
+    with trava_escrita(), get_conn() as con:
+        if con.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone() is None:
+            con.execute("ANALYZE")
+        else:
+            con.execute("PRAGMA optimize")
+    return True
+
+ensure_migrations()
+
+# quantidade/loan_id já saem inteiros do SQLite (texto inválido/NULL -> 0): o read_sql
+# entrega int64 direto, sem to_numeric + fillna + astype no pandas
+SQL_SELECT_MOV = (
+    "SELECT timestamp,data,hora,tipo,item_nome,categoria,aluno_nome,aluno_sobrenome,aluno_serie,"
+    "responsavel,prev_devolucao,observacoes,IFNULL(CAST(quantidade AS INTEGER), 0) AS quantidade,"
+    "beneficiario_tipo,beneficiario_nome,IFNULL(CAST(loan_id AS INTEGER), 0) AS loan_id "
+    "FROM movimentacoes"
+)
+# id decrescente na leitura: o sort estável por timestamp de _normaliza_mov desempata pelo
+# id (mais novo primeiro), igual a ORDER BY timestamp DESC, id DESC e ao prepend de _junta_mov
+ORDEM_MOV = " ORDER BY id DESC"
+
+COLS_MOV_TEXTO = [c for c in COLS_MOV if c not in ("timestamp","quantidade","loan_id")]
+# poucos valores distintos (tipo, categoria, série...): category guarda um código por linha
+COLS_MOV_CATEGORIA = ["tipo","categoria","aluno_serie","beneficiario_tipo"]
+
+def _normaliza_mov(df: pd.DataFrame) -> pd.DataFrame:
     if df.empty:
         return pd.DataFrame(columns=COLS_MOV)
-    # coerção
-    if "quantidade" in df.columns:
-        df["quantidade"] = pd.to_numeric(df["quantidade"], errors="coerce").fillna(0).astype(int)
-    if "loan_id" in df.columns:
-        df["loan_id"] = pd.to_numeric(df["loan_id"], errors="coerce").fillna(0).astype(int)
     # preenche colunas faltantes
     for c in COLS_MOV:
         if c not in df.columns:
             df[c] = "" if c not in ("quantidade","loan_id") else 0
-    return df[COLS_MOV].copy()
+    # tipos definitivos uma única vez: timestamp como datetime64 e texto em
+    # string[pyarrow] (sem nulos) para os filtros .str rodarem nos kernels do Arrow
+    df["timestamp"] = pd.to_datetime(df["timestamp"], errors="coerce", format="ISO8601")
+    for c in COLS_MOV_TEXTO:
+        df[c] = df[c].fillna("").astype("string[pyarrow]")
+    for c in COLS_MOV_CATEGORIA:
+        df[c] = df[c].astype("category")
+    # mais recentes primeiro, uma vez por versão do banco: o histórico da Consulta
+    # (e qualquer filtro, que preserva a ordem) já sai ordenado. Empates de timestamp
+    # ficam na ordem de entrada, que é id decrescente (ORDEM_MOV)
+    out = df[COLS_MOV].sort_values("timestamp", ascending=False, kind="stable", ignore_index=True)
+    # nome/sobrenome/professor numa coluna só (separador que não se digita): o filtro
+    # de nome da Consulta vira um único contains em vez de três. Já em casefold (a regra de
+    # contem() no export), junto com o item, para cada tecla não refazer a coluna inteira.
+    out["_nome_busca"] = (out["aluno_nome"] + "\x1f" + out["aluno_sobrenome"] + "\x1f" + out["beneficiario_nome"]).str.casefold()
+    out["_item_busca"] = out["item_nome"].str.casefold()
+    return out
 
-@st.cache_data(ttl=5)
-def df_itens() -> pd.DataFrame:
-    ensure_migrations()
-    with get_conn() as con:
+@st.cache_resource(show_spinner=False)
+def _estado_mov() -> dict:
+    """Movimentações normalizadas em memória entre reruns, com a versão do banco e o
+       último id/contagem já lidos (base da leitura incremental de df_mov)."""
+    return {"df": None, "versao": None, "ultimo_id": 0, "n": 0, "trava": threading.Lock()}
+
+def _invalida_mov():
+    """Força df_mov a conferir o banco na próxima leitura (mesmo que o mtime não tenha mudado)."""
+    _estado_mov()["versao"] = None
+
+def _junta_mov(novos: pd.DataFrame, antigo: pd.DataFrame) -> pd.DataFrame | None:
+    """Anexa linhas novas ao frame já normalizado. Só vale se todas forem mais recentes que
+       o frame (a ordem do mais recente para o mais antigo se mantém sem reordenar); senão None."""
+    if novos["timestamp"].isna().any() or not (novos["timestamp"].min() > antigo["timestamp"].max()):
+        return None
+    df = pd.concat([novos, antigo], ignore_index=True)
+    for c in COLS_MOV_CATEGORIA:  # categorias diferentes viram object no concat
+        df[c] = df[c].astype("category")
+    return df
+
+def df_mov() -> pd.DataFrame:
+    """Movimentações, do mais recente para o mais antigo. Fora a migração (que roda antes de
+       qualquer leitura), a tabela só recebe INSERTs: a cada versão nova do banco, lê só as linhas
+       com id acima do último lido e as anexa; se a contagem não fechar, relê tudo.
+       Lê por conn_leitura: só lotes já confirmados entram, então ultimo_id nunca passa de
+       linhas cujo loan_id ainda não foi gravado. O frame é compartilhado entre sessões: não alterar."""
+    est = _estado_mov()
+    versao = versao_db()
+    with est["trava"]:
+        if est["df"] is not None and est["versao"] == versao:
+            return est["df"]
+        df = None
+        with conn_leitura() as con:
+            n, ultimo_id = con.execute("SELECT COUNT(*), IFNULL(MAX(id), 0) FROM movimentacoes").fetchone()
+            if est["df"] is not None and not est["df"].empty and ultimo_id >= est["ultimo_id"]:
+                novos = pd.read_sql_query(SQL_SELECT_MOV + " WHERE id > ?" + ORDEM_MOV, con,
+                                          params=(est["ultimo_id"],))
+                if est["n"] + len(novos) == n:
+                    df = est["df"] if novos.empty else _junta_mov(_normaliza_mov(novos), est["df"])
+            if df is None:
+                df = _normaliza_mov(pd.read_sql_query(SQL_SELECT_MOV + ORDEM_MOV, con))
+        est.update(df=df, versao=versao, ultimo_id=ultimo_id, n=n)
+        return df
+
+def sql_export_movimentos(colunas: list[str], ini_iso: str, fim_iso: str, filtro_nome: str = "",
+                          filtro_item: str = "", filtro_tipo: str = "Todos",
+                          somente_prof: bool = False) -> tuple[str, list]:
+    """SELECT do export: período (range scan em idx_mov_ts_us) + os mesmos filtros de
+       filtrar_movimentos, resolvidos no SQLite para as linhas irem direto do cursor à planilha.
+       Sem ts_us, compara o TEXT ISO-8601 (que segue a ordem cronológica)."""
+    if tem_ts_us():
+        # timestamp que o strftime do SQLite não entende (formato antigo) deixa ts_us NULL:
+        # essas linhas seguem pela comparação de TEXT e vêm antes na ordem
+        ordem = "ts_us, timestamp"
+        where = ["(ts_us BETWEEN ? AND ? OR (ts_us IS NULL AND timestamp BETWEEN ? AND ?))"]
+        params = [_epoch_us(ini_iso), _epoch_us(fim_iso), ini_iso, fim_iso]
+    else:
+        ordem = "timestamp"
+        where, params = ["timestamp BETWEEN ? AND ?"], [ini_iso, fim_iso]
+    if filtro_nome:
+        where.append("(contem(aluno_nome, ?) OR contem(aluno_sobrenome, ?) OR contem(beneficiario_nome, ?))")
+        params += [filtro_nome] * 3
+    if filtro_item:
+        where.append("contem(item_nome, ?)")
+        params.append(filtro_item)
+    if filtro_tipo != "Todos":
+        where.append("tipo = ?")
+        params.append(filtro_tipo)
+    if somente_prof:
+        where.append("beneficiario_tipo = 'professor'")
+    sel = ", ".join("CAST(IFNULL(quantidade, 0) AS INTEGER) AS quantidade" if c == "quantidade" else c for c in colunas)
+    return f"SELECT {sel} FROM movimentacoes WHERE {' AND '.join(where)} ORDER BY {ordem}", params
+
+def filtrar_movimentos(df: pd.DataFrame, filtro_nome: str = "", filtro_item: str = "",
+                       filtro_tipo: str = "Todos", somente_prof: bool = False) -> pd.DataFrame:
+    """Aplica os filtros da aba Consulta (nome/sobrenome, item, tipo, professor).
+       Busca por substring literal (regex=False) e uma única máscara booleana no fim."""
+    if df.empty:
+        return df
+    masks = []
+    if filtro_nome:
+        masks.append(df['_nome_busca'].str.contains(filtro_nome.casefold(), regex=False, na=False))
+    if filtro_item:
+        masks.append(df['_item_busca'].str.contains(filtro_item.casefold(), regex=False, na=False))
+    if filtro_tipo != "Todos":
+        masks.append(df['tipo']==filtro_tipo)
+    if somente_prof:
+        masks.append(df['beneficiario_tipo']=="professor")
+    if not masks:
+        return df
+    return df[np.logical_and.reduce([np.asarray(m, dtype=bool) for m in masks])]
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _df_itens(versao: tuple) -> pd.DataFrame:
+    with conn_leitura() as con:
         df = pd.read_sql_query(
             "SELECT item_nome,categoria,titulo,autor,editora,genero,isbn,edicao,quant_total FROM itens",
             con,
@@ -261,187 +585,562 @@ def df_itens() -> pd.DataFrame:
     if df.empty:
         return pd.DataFrame(columns=COLS_ITENS)
     df["quant_total"] = pd.to_numeric(df["quant_total"], errors="coerce").fillna(0).astype(int)
-    return df[COLS_ITENS].fillna("")
+    df = df[COLS_ITENS].fillna("")
+    df[["categoria","genero"]] = df[["categoria","genero"]].astype("category")
+    return df
 
-@st.cache_data(ttl=5)
-def df_alunos() -> pd.DataFrame:
-    ensure_migrations()
-    with get_conn() as con:
+def df_itens() -> pd.DataFrame:
+    """Catálogo. O cache é chaveado pela versão do banco (versao_db): só relê após uma escrita."""
+    return _df_itens(versao_db())
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _df_itens_full(versao: tuple) -> pd.DataFrame:
+    with conn_leitura() as con:
+        df = pd.read_sql_query(
+            "SELECT id,item_nome,categoria,titulo,autor,editora,genero,isbn,edicao,quant_total FROM itens",
+            con,
+        )
+    # indexado pelo id (mantido também como coluna): o item escolhido sai por .loc, sem máscara
+    return df.set_index("id", drop=False)
+
+def df_itens_full() -> pd.DataFrame:
+    """Catálogo com id e valores crus (NULL preservado), para Editar/Excluir; cache por versao_db."""
+    return _df_itens_full(versao_db())
+
+def _texto_ou(s: pd.Series, alternativa) -> pd.Series:
+    """`valor or alternativa` coluna a coluna: NULL/vazio cai na alternativa (escalar ou Series)."""
+    s = s.fillna("").astype(str)
+    return s.where(s != "", alternativa)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _rotulos_edicao(versao: tuple) -> dict[int, str]:
+    dff = df_itens_full()
+    if dff.empty:
+        return {}
+    rotulo = ("[" + _texto_ou(dff["categoria"], "Livro") + "] "
+              + _texto_ou(dff["titulo"], _texto_ou(dff["item_nome"], ""))
+              + " — ISBN: " + _texto_ou(dff["isbn"], "s/ISBN")
+              + " (Unid: " + pd.to_numeric(dff["quant_total"], errors="coerce").fillna(0).astype(int).astype(str) + ")")
+    return dict(zip(dff["id"].astype(int).tolist(), rotulo.tolist()))
+
+def rotulos_edicao() -> dict[int, str]:
+    """Rótulos do seletor de Editar/Excluir (por id), montados com operações de coluna
+       uma vez por versão do banco."""
+    return _rotulos_edicao(versao_db())
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _df_alunos(versao: tuple) -> pd.DataFrame:
+    with conn_leitura() as con:
         df = pd.read_sql_query("SELECT nome,sobrenome,serie FROM alunos", con)
     if df.empty:
         return pd.DataFrame(columns=COLS_ALUNOS)
     return df[COLS_ALUNOS].fillna("")
 
+def df_alunos() -> pd.DataFrame:
+    """Alunos cadastrados (cache chaveado por versao_db, como df_itens)."""
+    return _df_alunos(versao_db())
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _alunos_opcoes(versao: tuple) -> tuple[list[str], list[tuple[str, str, str]]]:
+    """Rótulos "Nome Sobrenome — Série" do autocomplete (concatenação vetorizada)
+       e, na mesma ordem, as tuplas (nome, sobrenome, série) para o preenchimento."""
+    dfa = df_alunos()
+    if dfa.empty:
+        return [], []
+    labels = (dfa["nome"] + " " + dfa["sobrenome"] + " — " + dfa["serie"]).str.strip().tolist()
+    return labels, list(dfa[["nome","sobrenome","serie"]].itertuples(index=False, name=None))
+
+def alunos_opcoes() -> tuple[list[str], list[tuple[str, str, str]]]:
+    return _alunos_opcoes(versao_db())
+
 # CRUD helpers
 
-def inserir_movimento(reg: dict) -> int:
-    """Insere movimento. Se for Emprestimo sem loan_id, atribui loan_id=id do próprio registro.
-       Retorna o id do movimento inserido."""
-    ensure_migrations()
+def limpa_caches_itens():
+    """Limpa tudo que deriva de itens/saldos (catálogo, saldos, rótulos, status, pendentes, export).
+       Chamada após qualquer escrita em itens ou movimentacoes."""
+    _df_itens.clear(); _df_itens_full.clear(); _rotulos_edicao.clear(); _saldo_por_item.clear()
+    _rotulos_itens.clear(); _status_atual.clear(); _emprestimos_pendentes.clear()
+    _xlsx_catalogo.clear()
+
+def inserir_movimentos_bulk(regs: list[dict], aluno: tuple[str, str, str] | None = None) -> list[int]:
+    """Insere vários movimentos numa única transação (executemany).
+       Empréstimos sem loan_id recebem loan_id=id do próprio registro.
+       `aluno` (nome, sobrenome, série), se informado, é cadastrado na mesma transação.
+       Retorna os ids inseridos, na mesma ordem de `regs`."""
+    if not regs:
+        return []
     # valores padrão
     base = {c: (0 if c in ("quantidade","loan_id") else "") for c in COLS_MOV}
-    reg2 = {**base, **reg}
-    if not reg2.get("quantidade"):
-        reg2["quantidade"] = 1
-    with get_conn() as con:
+    rows = []
+    for reg in regs:
+        reg2 = {**base, **reg}
+        if not reg2.get("quantidade"):
+            reg2["quantidade"] = 1
+        rows.append([reg2.get(c, "") for c in COLS_MOV])
+    with trava_escrita(), get_conn() as con:
         cur = con.cursor()
-        cur.execute(
+        # IMMEDIATE: garante que nenhum outro escritor intercale ids no lote
+        cur.execute("BEGIN IMMEDIATE")
+        ultimo_id = cur.execute("SELECT IFNULL(MAX(id), 0) FROM movimentacoes").fetchone()[0]
+        novo_aluno = aluno is not None and cur.execute(
+            "INSERT OR IGNORE INTO alunos (nome,sobrenome,serie) VALUES (?,?,?)", aluno
+        ).rowcount > 0
+        cur.executemany(
             """
             INSERT INTO movimentacoes (
                 timestamp,data,hora,tipo,item_nome,categoria,aluno_nome,aluno_sobrenome,aluno_serie,
                 responsavel,prev_devolucao,observacoes,quantidade,beneficiario_tipo,beneficiario_nome,loan_id
             ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
             """,
-            [reg2.get(c, "") for c in COLS_MOV],
+            rows,
         )
-        mid = cur.lastrowid
-        # Se for empréstimo e loan_id não veio, marca loan_id = id
-        if str(reg2.get("tipo","")).lower().startswith("emprest") and (not reg2.get("loan_id")):
-            cur.execute("UPDATE movimentacoes SET loan_id = ? WHERE id = ?", (int(mid), int(mid)))
-        con.commit()
-    # limpa caches
-    df_mov.clear(); df_itens.clear()
-    return int(mid)
+        # Empréstimos do lote sem loan_id: marca loan_id = id (um único UPDATE)
+        cur.execute(
+            """
+            UPDATE movimentacoes
+               SET loan_id = id
+             WHERE id > ?
+               AND (loan_id IS NULL OR loan_id = 0)
+               AND lower(tipo) LIKE 'emprest%'
+            """,
+            (int(ultimo_id),),
+        )
+        ids = [int(r[0]) for r in cur.execute("SELECT id FROM movimentacoes WHERE id > ? ORDER BY id", (int(ultimo_id),))]
+        commit_escrita(con)
+    # limpa caches uma vez por lote
+    _invalida_mov(); limpa_caches_itens()
+    if novo_aluno:
+        _df_alunos.clear(); _alunos_opcoes.clear()
+    return ids
+
+def inserir_movimento(regs: dict | list[dict], aluno: tuple[str, str, str] | None = None) -> int | list[int]:
+    """Insere um movimento (dict) ou vários (lista de dicts) numa só transação.
+       Retorna o id inserido (dict) ou a lista de ids (lista)."""
+    if isinstance(regs, dict):
+        return inserir_movimentos_bulk([regs], aluno)[0]
+    return inserir_movimentos_bulk(list(regs), aluno)
+
+def _prepara_item(campos: dict) -> tuple[tuple | None, list]:
+    """Chave de busca e valores (na ordem de COLS_ITENS) de um upsert do catálogo.
+       Chave preferencial: isbn; fallback: titulo+autor+edicao; para Jogo: item_nome.
+       Retorna ("isbn", isbn), ("obra", (titulo, autor, edicao)), ("nome", item_nome) ou None."""
+    isbn = (campos.get("isbn") or "").strip()
+    titulo = (campos.get("titulo") or "").strip()
+    autor = (campos.get("autor") or "").strip()
+    edicao = (campos.get("edicao") or "").strip()
+    item_nome = (campos.get("item_nome") or "").strip()
+    categoria = (campos.get("categoria") or "Livro").strip()
+
+    if categoria.lower() == "jogo":
+        chave = ("nome", item_nome) if item_nome else None
+    elif isbn:
+        chave = ("isbn", isbn)
+    else:
+        chave = ("obra", (titulo, autor, edicao))
+
+    campos.setdefault("quant_total", 1)
+    campos.setdefault("categoria", categoria or "Livro")
+    if not item_nome:
+        campos["item_nome"] = (titulo or isbn or autor)
+    return chave, [campos.get(k) for k in COLS_ITENS]
+
+SQL_BUSCA_ITEM = {
+    "nome": "SELECT id FROM itens WHERE item_nome=?",
+    "isbn": "SELECT id FROM itens WHERE isbn=?",
+    "obra": "SELECT id FROM itens WHERE (titulo=? AND autor=? AND IFNULL(edicao,'')=?)",
+}
+SQL_UPDATE_ITEM = f"UPDATE itens SET {','.join(f'{k}=?' for k in COLS_ITENS)} WHERE id=?"
+SQL_INSERT_ITEM = f"INSERT INTO itens ({','.join(COLS_ITENS)}) VALUES ({','.join('?' * len(COLS_ITENS))})"
+# Jogo: a chave é item_nome, que já é UNIQUE -> um único INSERT ... ON CONFLICT
+SQL_UPSERT_ITEM_NOME = (SQL_INSERT_ITEM + " ON CONFLICT(item_nome) DO UPDATE SET "
+                        + ",".join(f"{k}=excluded.{k}" for k in COLS_ITENS if k != "item_nome"))
+
+def _upsert_item(con: sqlite3.Connection, campos: dict) -> None:
+    chave, valores = _prepara_item(campos)
+    if chave and chave[0] == "nome" and valores[0] == chave[1]:
+        con.execute(SQL_UPSERT_ITEM_NOME, valores)
+        return
+    row = None
+    if chave:
+        busca = chave[1] if chave[0] == "obra" else (chave[1],)
+        row = con.execute(SQL_BUSCA_ITEM[chave[0]], busca).fetchone()
+    if row:
+        con.execute(SQL_UPDATE_ITEM, valores + [row[0]])
+    else:
+        con.execute(SQL_INSERT_ITEM, valores)
 
 def upsert_item_catalogo(**campos):
-    # chave preferencial: isbn; fallback: titulo+autor+edicao; para Jogo: item_nome
-    ensure_migrations()
-    with get_conn() as con:
-        isbn = (campos.get("isbn") or "").strip()
-        titulo = (campos.get("titulo") or "").strip()
-        autor = (campos.get("autor") or "").strip()
-        edicao = (campos.get("edicao") or "").strip()
-        item_nome = (campos.get("item_nome") or "").strip()
-        categoria = (campos.get("categoria") or "Livro").strip()
-
-        row = None
-        if categoria.lower() == "jogo":
-            if item_nome:
-                cur = con.execute("SELECT id FROM itens WHERE item_nome=?", (item_nome,))
-                row = cur.fetchone()
-        else:
-            if isbn:
-                cur = con.execute("SELECT id FROM itens WHERE isbn=?", (isbn,))
-                row = cur.fetchone()
-            else:
-                cur = con.execute(
-                    "SELECT id FROM itens WHERE (titulo=? AND autor=? AND IFNULL(edicao,'')=?)",
-                    (titulo, autor, edicao),
-                )
-                row = cur.fetchone()
-
-        campos.setdefault("quant_total", 1)
-        campos.setdefault("categoria", categoria or "Livro")
-        if not item_nome:
-            campos["item_nome"] = (titulo or isbn or autor)
+    with trava_escrita(), get_conn() as con:
+        _upsert_item(con, campos)
+        commit_escrita(con)
+    limpa_caches_itens()
+
+def _chaves_item(v: dict) -> list[tuple]:
+    """Chaves sob as quais uma linha de itens é encontrada (NULL nunca casa no SQL)."""
+    txt = lambda x: None if x is None else str(x)
+    nome, isbn, titulo, autor = txt(v["item_nome"]), txt(v["isbn"]), txt(v["titulo"]), txt(v["autor"])
+    out = []
+    if nome is not None:
+        out.append(("nome", nome))
+    if isbn is not None:
+        out.append(("isbn", isbn))
+    if titulo is not None and autor is not None:
+        out.append(("obra", (titulo, autor, txt(v["edicao"]) or "")))
+    return out
 
-        if row:
-            set_clause = ",".join([f"{k}=?" for k in ["item_nome","categoria","titulo","autor","editora","genero","isbn","edicao","quant_total"]])
-            params = [campos.get(k) for k in ["item_nome","categoria","titulo","autor","editora","genero","isbn","edicao","quant_total"]] + [row[0]]
-            con.execute(f"UPDATE itens SET {set_clause} WHERE id=?", params)
-        else:
-            con.execute(
-                """
-                INSERT INTO itens (item_nome,categoria,titulo,autor,editora,genero,isbn,edicao,quant_total)
-                VALUES (?,?,?,?,?,?,?,?,?)
-                """,
-                [campos.get(k) for k in ["item_nome","categoria","titulo","autor","editora","genero","isbn","edicao","quant_total"]],
-            )
-        con.commit()
-    df_itens.clear()
+def upsert_itens_bulk(linhas: list[dict]) -> int:
+    """Upsert de vários itens numa única transação (um commit/fsync para o lote todo).
+       O catálogo é lido uma vez para os dicionários de busca (isbn, obra, item_nome); as
+       escritas seguem linha a linha, então cada linha vê as anteriores do lote e o UNIQUE
+       de item_nome continua com o SQLite. Retorna o nº de linhas."""
+    if not linhas:
+        return 0
+    with trava_escrita(), get_conn() as con:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            # (tipo, chave) -> ids em ordem crescente: a busca pelo índice devolve o menor id primeiro
+            busca, chaves = {}, {}
+            def indexa(i, v):
+                for k in chaves.pop(i, ()):
+                    busca[k].remove(i)
+                chaves[i] = _chaves_item(v)
+                for k in chaves[i]:
+                    insort(busca.setdefault(k, []), i)
+            for r in con.execute(f"SELECT id,{','.join(COLS_ITENS)} FROM itens ORDER BY id"):
+                indexa(r[0], dict(zip(COLS_ITENS, r[1:])))
+            for campos in linhas:
+                chave, valores = _prepara_item(dict(campos))
+                ids = busca.get(chave) if chave else None
+                if chave and chave[0] == "nome" and valores[0] == chave[1]:
+                    # mesmo INSERT ... ON CONFLICT de _upsert_item
+                    cur = con.execute(SQL_UPSERT_ITEM_NOME, valores)
+                    i = ids[0] if ids else cur.lastrowid
+                elif ids:
+                    i = ids[0]
+                    con.execute(SQL_UPDATE_ITEM, valores + [i])
+                else:
+                    i = con.execute(SQL_INSERT_ITEM, valores).lastrowid
+                indexa(i, dict(zip(COLS_ITENS, valores)))
+        except Exception:
+            con.rollback()
+            raise
+        commit_escrita(con)
+    limpa_caches_itens()
+    return len(linhas)
+
+def update_item(item_id: int, **fields):
+    """Atualiza os campos informados de um item (um UPDATE numa transação da conexão única)."""
+    cols = [k for k in COLS_ITENS if k in fields]
+    if not cols:
+        return
+    set_clause = ",".join([f"{k}=?" for k in cols])
+    vals = [fields[k] for k in cols] + [item_id]
+    with trava_escrita(), get_conn() as con:
+        con.execute(f"UPDATE itens SET {set_clause} WHERE id=?", vals)
+        commit_escrita(con)
+    limpa_caches_itens()
+
+def delete_item(item_id: int):
+    with trava_escrita(), get_conn() as con:
+        con.execute("DELETE FROM itens WHERE id=?", (item_id,))
+        commit_escrita(con)
+    limpa_caches_itens()
+
+def linhas_catalogo_excel(excel: pd.DataFrame, mapa: dict[str, str | None]) -> list[dict]:
+    """Converte a planilha importada em linhas para `upsert_itens_bulk`, coluna a coluna.
+       `mapa` liga cada campo (titulo, autor, ..., quant_total) a uma coluna da planilha ou None."""
+    vazio = pd.Series("", index=excel.index, dtype=object)
+    def texto(campo):
+        c = mapa.get(campo)
+        if not c or c not in excel.columns:
+            return vazio
+        col = excel[c]
+        return col.astype(str).str.strip().where(col.notna(), "")
+    sub = pd.DataFrame({c: texto(c) for c in ("titulo","autor","editora","genero","isbn","edicao")})
+    # Unidades: número truncado, mínimo 1; vazio/inválido vale 1
+    qt = pd.to_numeric(texto("quant_total"), errors="coerce").replace([np.inf, -np.inf], np.nan)
+    sub["quant_total"] = np.trunc(qt.fillna(1)).clip(lower=1).astype(int)
+    sub["item_nome"] = sub["titulo"].where(sub["titulo"] != "", sub["isbn"])
+    sub["item_nome"] = sub["item_nome"].where(sub["item_nome"] != "", sub["autor"])
+    sub["categoria"] = "Livro"
+    return sub.to_dict("records")
 
 # ---------------- Regras de saldo e status ----------------
 
-def saldo_por_item(dfm: pd.DataFrame) -> pd.DataFrame:
+SQL_EMPRESTADO_POR_ITEM = """
+    SELECT IFNULL(item_nome, '') AS item_nome,
+           SUM(CASE WHEN lower(tipo) LIKE 'emprest%' THEN  CAST(IFNULL(quantidade, 0) AS INTEGER)
+                    WHEN lower(tipo) LIKE 'devolu%'  THEN -CAST(IFNULL(quantidade, 0) AS INTEGER)
+                    ELSE 0 END) AS emprestado
+      FROM movimentacoes
+     GROUP BY IFNULL(item_nome, '')
+"""
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _saldo_por_item(versao: tuple) -> pd.DataFrame:
     dfi = df_itens()
     base = (dfi[["item_nome","titulo","quant_total"]].copy()
             if not dfi.empty else pd.DataFrame(columns=["item_nome","titulo","quant_total"]))
-    if dfm.empty:
+    # soma com sinal já agregada no SQLite: volta uma linha por item, não por movimento
+    with conn_leitura() as con:
+        agg = pd.read_sql_query(SQL_EMPRESTADO_POR_ITEM, con)
+    if agg.empty:
         base["emprestado"] = 0
         base["disponivel"] = base["quant_total"]
         return base
-    mov = dfm.copy()
-    mov["sinal"] = mov["tipo"].str.lower().map(lambda t: 1 if t.startswith("emprest") else (-1 if t.startswith("devolu") else 0))
-    mov["delta"] = mov["quantidade"].astype(int) * mov["sinal"]
-    agg = mov.groupby("item_nome")["delta"].sum().rename("emprestado").reset_index()
-    out = base.merge(agg, on="item_nome", how="left").fillna({"emprestado":0})
+    # itens.item_nome aceita vários NULL (viram "" em df_itens): só o lado do agregado é único
+    out = base.merge(agg, on="item_nome", how="left", validate="m:1").fillna({"emprestado":0})
     out["emprestado"] = out["emprestado"].astype(int).clip(lower=0)
     out["disponivel"] = (out["quant_total"] - out["emprestado"]).clip(lower=0)
     return out
 
-def status_itens(dfm: pd.DataFrame) -> pd.DataFrame:
+def saldo_por_item() -> pd.DataFrame:
+    """Emprestado/disponível por item do catálogo (cache chaveado por versao_db)."""
+    return _saldo_por_item(versao_db())
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _rotulos_itens(versao: tuple) -> dict[str, str]:
+    sal = saldo_por_item()
+    disp = dict(zip(sal["item_nome"], sal["disponivel"]))
+    return {
+        r.item_nome: f"[{r.categoria or 'Livro'}] {r.titulo or r.item_nome} "
+                     f"(disp: {int(disp.get(r.item_nome, r.quant_total))})"
+        for r in df_itens().itertuples(index=False)
+    }
+
+def rotulos_itens() -> dict[str, str]:
+    """Rótulos "[Categoria] Título (disp: n)" dos seletores de item (abas Aluno e Professor),
+       formatados uma vez por versão do banco."""
+    return _rotulos_itens(versao_db())
+
+def ultimos_movimentos() -> pd.DataFrame:
+    """Último movimento de cada item, a partir da tabela ultimo_mov (mantida por gatilhos)."""
+    with conn_leitura() as con:
+        return pd.read_sql_query(
+            """
+            SELECT m.item_nome, m.categoria, m.tipo, m.aluno_nome, m.aluno_sobrenome, m.aluno_serie, m.prev_devolucao
+              FROM ultimo_mov u
+              JOIN movimentacoes m ON m.id = u.mov_id
+            """,
+            con,
+        )
+
+def status_itens() -> pd.DataFrame:
+    """Situação de cada item: último movimento (ultimo_mov, uma linha por item) + saldos.
+       Não depende do histórico completo: nada de df_mov/ordenar/agrupar em pandas."""
     dfi = df_itens()
-    sal = saldo_por_item(dfm)
-    if dfm.empty:
+    sal = saldo_por_item()
+    ult = ultimos_movimentos()
+    if ult.empty:
         ult = pd.DataFrame(columns=["item_nome","categoria","status","aluno","turma","prev_devolucao"])
     else:
-        df = dfm.copy()
-        df["timestamp"] = pd.to_datetime(df["timestamp"], errors="coerce")
-        idx = df.sort_values("timestamp").groupby("item_nome").tail(1).index
-        ult = df.loc[idx, ["item_nome","categoria","tipo","aluno_nome","aluno_sobrenome","aluno_serie","prev_devolucao"]].copy()
-        ult["status"] = ult["tipo"].apply(lambda t: "Emprestado" if str(t).lower().startswith("emprest") else "Disponível")
+        ult["status"] = np.where(ult["tipo"].fillna("").str.lower().str.startswith("emprest"), "Emprestado", "Disponível")
         ult["aluno"] = (ult["aluno_nome"].fillna("") + " " + ult["aluno_sobrenome"].fillna("")).str.strip()
         ult["turma"] = ult["aluno_serie"].fillna("")
         ult = ult[["item_nome","categoria","status","aluno","turma","prev_devolucao"]]
     if not dfi.empty:
-        ult = ult.merge(dfi[["item_nome","titulo"]], on="item_nome", how="right").fillna("")
+        ult = ult.merge(dfi[["item_nome","titulo"]], on="item_nome", how="right", validate="1:m").fillna("")
     else:
         ult["titulo"] = ult["item_nome"]
-    ult = ult.merge(sal[["item_nome","quant_total","emprestado","disponivel"]],
-                    on="item_nome", how="left").fillna({"quant_total":0,"emprestado":0,"disponivel":0})
+    # sem validate: os dois lados herdam do catálogo as chaves "" repetidas de bancos antigos
+    ult = (ult.merge(sal[["item_nome","quant_total","emprestado","disponivel"]], on="item_nome", how="left")
+              .infer_objects().fillna({"quant_total":0,"emprestado":0,"disponivel":0}))
     return ult
 
+@st.cache_data(show_spinner=False, max_entries=4)
+def _status_atual(versao: tuple) -> pd.DataFrame:
+    return status_itens()
+
+def status_atual() -> pd.DataFrame:
+    """status_itens() cacheado por versao_db; limpo junto com df_mov/df_itens nas escritas."""
+    return _status_atual(versao_db())
+
 # ---------------- Empréstimos pendentes (por loan) ----------------
 
-def emprestimos_pendentes_df() -> pd.DataFrame:
-    """Retorna cada empréstimo com saldo pendente (>0), incluindo aluno/professor."""
-    dfm = df_mov()
-    if dfm.empty:
-        return pd.DataFrame(columns=[
-            "loan_id","item_nome","categoria","titulo","data","hora","prev_devolucao",
-            "beneficiario_tipo","beneficiario_nome","aluno_nome","aluno_sobrenome","aluno_serie",
-            "q_emprestado","q_devolvido","q_pendente","atrasado"
-        ])
-    # base: todos empréstimos (com loan_id == id, garantido pela migração)
-    emp = dfm[dfm["tipo"].str.lower().str.startswith("emprest")].copy()
-    if emp.empty:
-        return pd.DataFrame(columns=[
-            "loan_id","item_nome","categoria","titulo","data","hora","prev_devolucao",
-            "beneficiario_tipo","beneficiario_nome","aluno_nome","aluno_sobrenome","aluno_serie",
-            "q_emprestado","q_devolvido","q_pendente","atrasado"
-        ])
-
-    # devoluções por loan_id
-    dev = dfm[dfm["tipo"].str.lower().str.startswith("devolu") & (dfm["loan_id"]>0)][["loan_id","quantidade"]].groupby("loan_id").sum()
-    emp["q_devolvido"] = emp["loan_id"].map(dev["quantidade"]) if not dev.empty else 0
-    emp["q_devolvido"] = emp["q_devolvido"].fillna(0).astype(int)
-    emp["q_emprestado"] = emp["quantidade"].astype(int)
-    emp["q_pendente"] = (emp["q_emprestado"] - emp["q_devolvido"]).clip(lower=0).astype(int)
-
-    # junta título
-    dfi = df_itens()
-    if not dfi.empty:
-        emp = emp.merge(dfi[["item_nome","titulo"]], on="item_nome", how="left")
-    else:
-        emp["titulo"] = emp["item_nome"]
+COLS_PENDENTES = [
+    "loan_id","item_nome","categoria","titulo","data","hora","prev_devolucao",
+    "beneficiario_tipo","beneficiario_nome","aluno_nome","aluno_sobrenome","aluno_serie",
+    "q_emprestado","q_devolvido","q_pendente","atrasado"
+]
 
-    # atraso
-    def _is_late(s):
-        try:
-            if not s: return False
-            d = datetime.strptime(s, "%d/%m/%Y").date()
-            return d < date.today()
-        except Exception:
-            return False
-    emp["atrasado"] = emp["prev_devolucao"].apply(_is_late)
-
-    # apenas pendentes
-    cols = ["loan_id","item_nome","categoria","titulo","data","hora","prev_devolucao",
-            "beneficiario_tipo","beneficiario_nome","aluno_nome","aluno_sobrenome","aluno_serie",
-            "q_emprestado","q_devolvido","q_pendente","atrasado"]
-    out = emp.loc[emp["q_pendente"]>0, cols].sort_values(["atrasado","prev_devolucao","data","hora"], ascending=[False, True, True, True])
+# Empréstimos com saldo (emprestado - devolvido por loan_id) > 0, já com o título do catálogo.
+# titulo: '' se o item não tem título, NULL se não está no catálogo, item_nome com catálogo vazio.
+SQL_PENDENTES = """
+SELECT IFNULL(e.loan_id, 0) AS loan_id, e.item_nome, e.categoria,
+       CASE WHEN i.id IS NOT NULL THEN IFNULL(i.titulo, '')
+            WHEN NOT EXISTS (SELECT 1 FROM itens) THEN e.item_nome END AS titulo,
+       e.data, e.hora, e.prev_devolucao, e.beneficiario_tipo, e.beneficiario_nome,
+       e.aluno_nome, e.aluno_sobrenome, e.aluno_serie,
+       IFNULL(e.quantidade, 0) AS q_emprestado, IFNULL(d.q, 0) AS q_devolvido
+  FROM movimentacoes e
+  LEFT JOIN (SELECT loan_id, SUM(quantidade) AS q FROM movimentacoes
+              WHERE lower(tipo) LIKE 'devolu%' AND loan_id > 0
+              GROUP BY loan_id) d ON d.loan_id = e.loan_id
+  LEFT JOIN itens i ON i.item_nome = e.item_nome
+ WHERE lower(e.tipo) LIKE 'emprest%'
+   AND IFNULL(e.quantidade, 0) - IFNULL(d.q, 0) > 0
+"""
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _emprestimos_pendentes(versao: tuple, hoje: date) -> pd.DataFrame:
+    with conn_leitura() as con:
+        emp = pd.read_sql_query(SQL_PENDENTES, con)
+    if emp.empty:
+        return pd.DataFrame(columns=COLS_PENDENTES)
+    texto = ["data","hora","prev_devolucao","beneficiario_tipo","beneficiario_nome",
+             "aluno_nome","aluno_sobrenome","aluno_serie","item_nome","categoria"]
+    emp[texto] = emp[texto].fillna("")
+    for c in ("loan_id","q_emprestado","q_devolvido"):
+        emp[c] = pd.to_numeric(emp[c], errors="coerce").fillna(0).astype(int)
+    emp["q_pendente"] = emp["q_emprestado"] - emp["q_devolvido"]
+
+    # atraso: parse vetorizado; vazio/inválido vira NaT, que nunca é "< hoje"
+    prev = pd.to_datetime(emp["prev_devolucao"], format="%d/%m/%Y", errors="coerce")
+    emp["atrasado"] = prev < pd.Timestamp(hoje)
+
+    # loan_id desempata na ordem de registro
+    out = emp[COLS_PENDENTES].sort_values(["atrasado","prev_devolucao","data","hora","loan_id"],
+                                          ascending=[False, True, True, True, True])
     return out.reset_index(drop=True)
 
+def emprestimos_pendentes_df() -> pd.DataFrame:
+    """Retorna cada empréstimo com saldo pendente (>0), incluindo aluno/professor.
+       Saldo por loan_id e título resolvidos no SQLite (só as linhas pendentes chegam ao pandas).
+       Cache por versao_db e pelo dia (o "atrasado" muda na virada da data)."""
+    return _emprestimos_pendentes(versao_db(), date.today())
+
+# ---------------- Exportação Excel ----------------
+
+# colunas das planilhas (rótulo, coluna de origem), montadas uma vez no import
+EXPORT_MOV_COLS = [
+    ("Data","data"),("Hora","hora"),("Tipo","tipo"),("Item","item_nome"),("Categoria","categoria"),
+    ("Quantidade","quantidade"),("BeneficiárioTipo","beneficiario_tipo"),("BeneficiárioNome","beneficiario_nome"),
+    ("Nome","aluno_nome"),("Sobrenome","aluno_sobrenome"),("Série","aluno_serie"),
+    ("Prev. Devolução","prev_devolucao"),("Responsável","responsavel"),("Obs.","observacoes"),
+]
+EXPORT_MOV_COLUNAS = [c for _,c in EXPORT_MOV_COLS]
+EXPORT_MOV_ROTULOS = [r for r,_ in EXPORT_MOV_COLS]
+
+EXPORT_PEND_COLS = [
+    ("LoanID","loan_id"),
+    ("Data","data"),("Hora","hora"),
+    ("Categoria","categoria"),("Título/Item","titulo"),
+    ("Item (chave)","item_nome"),
+    ("Qtd Emp.","q_emprestado"),("Qtd Dev.","q_devolvido"),("Qtd Pendente","q_pendente"),
+    ("Prev. Devolução","prev_devolucao"),
+    ("Tipo Beneficiário","beneficiario_tipo"),
+    ("Nome Beneficiário","beneficiario_nome"),
+    ("Aluno Nome","aluno_nome"),("Aluno Sobrenome","aluno_sobrenome"),("Série","aluno_serie"),
+    ("Atrasado","atrasado"),
+]
+EXPORT_PEND_COLUNAS = [c for _,c in EXPORT_PEND_COLS]
+EXPORT_PEND_RENAME = dict(EXPORT_PEND_COLS)
+
+def aba_aviso(msg: str) -> pd.DataFrame:
+    """Aba de uma célula ("Info") para planilhas sem linhas; só montada quando usada."""
+    return pd.DataFrame({"Info": [msg]})
+
+CATALOGO_VAZIO = aba_aviso("Catálogo vazio")
+
+def larguras_colunas(df: pd.DataFrame, limite: int = 40) -> list[int]:
+    """Largura sugerida por coluna (cabeçalho vs. maior valor), uma passada vetorizada por coluna.
+       Colunas string já medem direto (kernel do Arrow), sem converter cada célula para str."""
+    out = []
+    for c in df.columns:
+        col = df[c]
+        if not len(df):
+            maior = 0
+        elif pd.api.types.is_string_dtype(col.dtype) and col.dtype != object:
+            maior = int(col.str.len().max(skipna=True) or 0)
+        else:
+            maior = int(col.astype(str).str.len().max())
+        out.append(min(max(len(str(c)), maior) + 2, limite))
+    return out
+
+def escrever_aba_xlsx(book, nome: str, df: pd.DataFrame):
+    """Escreve `df` linha a linha numa aba nova do workbook xlsxwriter `book`.
+       O modo constant_memory só aceita linhas em ordem crescente; o to_excel do pandas
+       escreve coluna a coluna e perderia dados, por isso o write_row direto."""
+    datas = [pd.api.types.is_datetime64_any_dtype(df.iloc[:, i]) for i in range(df.shape[1])]
+    # NaN/NaT viram célula vazia (write_number recusa NaN)
+    linhas = ([None if (v is pd.NaT or (isinstance(v, float) and v != v)) else v for v in row]
+              for row in df.itertuples(index=False, name=None))
+    return escrever_linhas_xlsx(book, nome, [str(c) for c in df.columns], linhas, larguras_colunas(df), datas)
+
+def escrever_linhas_xlsx(book, nome: str, colunas: list[str], linhas, larguras: list[int],
+                         datas: list[bool] | None = None):
+    """Escreve cabeçalho + linhas (qualquer iterável, p.ex. um cursor do SQLite) sem DataFrame intermediário."""
+    ws = book.add_worksheet(nome)
+    # formatação de colunas antes das linhas (já descarregadas no constant_memory);
+    # colunas datetime64 herdam o formato de data da coluna
+    fmt_data = book.add_format({"num_format": "yyyy-mm-dd hh:mm:ss"})
+    for i, w in enumerate(larguras):
+        eh_data = bool(datas and datas[i])
+        ws.set_column(i, i, max(w, 20) if eh_data else w, fmt_data if eh_data else None)
+    ws.write_row(0, 0, colunas)
+    for i, row in enumerate(linhas, start=1):
+        ws.write_row(i, 0, row)
+    return ws
+
+def xlsx_bytes(abas: dict[str, pd.DataFrame]) -> bytes:
+    """Planilha com uma aba por DataFrame, em constant_memory (cada linha vai para o
+       arquivo ao ser escrita)."""
+    buffer = BytesIO()
+    book = xlsxwriter.Workbook(buffer, XLSX_OPCOES)
+    for nome, df in abas.items():
+        escrever_aba_xlsx(book, nome, df)
+    book.close()
+    return buffer.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _xlsx_catalogo(versao: tuple) -> bytes:
+    dcurr = df_itens()
+    return xlsx_bytes({'catalogo': CATALOGO_VAZIO if dcurr.empty else dcurr})
+
+def xlsx_catalogo() -> bytes:
+    """Catálogo em .xlsx para o botão de exportação: só é regerado após uma escrita (versao_db)."""
+    return _xlsx_catalogo(versao_db())
+
+def escrever_consulta_xlsx(book, nome: str, con, sql: str, params: list,
+                           colunas: list[str], rotulos: list[str], aviso_vazio: str, limite: int = 40):
+    """Streaming do resultado de `sql` para a aba `nome`, com `rotulos` como cabeçalho (um por coluna).
+       Um agregado prévio dá a contagem e as larguras (o constant_memory exige set_column antes
+       das linhas); sem linhas, escreve o aviso."""
+    n, *maiores = con.execute(
+        f"SELECT COUNT(*), {', '.join(f'MAX(length({c}))' for c in colunas)} FROM ({sql})", params
+    ).fetchone()
+    if not n:
+        return escrever_aba_xlsx(book, nome, aba_aviso(aviso_vazio))
+    larguras = [min(max(len(r), m or 0) + 2, limite) for r, m in zip(rotulos, maiores)]
+    return escrever_linhas_xlsx(book, nome, rotulos, con.execute(sql, params), larguras)
+
+@st.cache_data(ttl=300, show_spinner=False, max_entries=4)
+def gerar_xlsx_movimentos(ini_iso: str, fim_iso: str, filtro_nome: str, filtro_item: str, filtro_tipo: str,
+                          somente_prof: bool, incluir_status: bool, aviso_vazio: str, versao: tuple) -> bytes:
+    """Planilha de movimentações do período/filtros. `versao` (versao_db()) invalida o cache
+       após qualquer escrita, então repetir o mesmo export não refaz a planilha."""
+    colunas = EXPORT_MOV_COLUNAS
+    sql, params = sql_export_movimentos(colunas, ini_iso, fim_iso, filtro_nome, filtro_item, filtro_tipo, somente_prof)
+    buffer = BytesIO()
+    # linhas vão do cursor direto para o arquivo, sem DataFrame nem ExcelWriter no meio
+    book = xlsxwriter.Workbook(buffer, XLSX_OPCOES)
+    with conn_leitura() as con:
+        escrever_consulta_xlsx(book, 'emprestimos', con, sql, params, colunas,
+                               EXPORT_MOV_ROTULOS, aviso_vazio)
+    if incluir_status:
+        escrever_aba_xlsx(book, 'status_atual', status_atual())
+    book.close()
+    return buffer.getvalue()
+
+def tabela_paginada(df: pd.DataFrame, key: str, por_pagina: int = LINHAS_POR_PAGINA):
+    """st.dataframe de uma página de `df`: só as linhas visíveis são serializadas para o navegador.
+       O seletor de página só aparece quando há mais de uma."""
+    paginas = max(1, -(-len(df) // por_pagina))
+    pagina = st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, value=1,
+                             key=key) if paginas > 1 else 1
+    ini = (int(pagina) - 1) * por_pagina
+    st.dataframe(df.iloc[ini:ini + por_pagina], use_container_width=True, hide_index=True)
+
 # ---------------- UI ----------------
 
 st.set_page_config(page_title="Sala de Leitura - Sistema", page_icon="📚", layout="wide")
@@ -462,21 +1161,26 @@ abas = st.tabs([
 ])
 
 # ------ Dados atuais ------
-dfm = df_mov()
 dfi = df_itens()
 dfa = df_alunos()
-saldos = saldo_por_item(dfm)
+saldos = saldo_por_item()
+# lookups O(1) por item (em vez de varrer dfi/saldos com máscara a cada linha)
+categoria_map = dict(zip(dfi["item_nome"], dfi["categoria"]))
+disp_map = dict(zip(saldos["item_nome"], saldos["disponivel"]))
+emp_map = dict(zip(saldos["item_nome"], saldos["emprestado"]))
+qtot_map = dict(zip(dfi["item_nome"], dfi["quant_total"]))
+item_labels = rotulos_itens()
 
 # Autocomplete de aluno
-alunos_options = []
-if not dfa.empty:
-    alunos_options = [f"{r.nome} {r.sobrenome} — {r.serie}".strip() for r in dfa.itertuples(index=False)]
+alunos_options, alunos_rows = alunos_opcoes()
+alunos_conhecidos = set(alunos_rows)
 
-def _base_registro(tipo:str, item_nome:str, categoria:str, quantidade:int, prev_dev:datetime|None, observ:str,
+def _novo_registro(tipo:str, item_nome:str, categoria:str, quantidade:int, prev_dev:datetime|None, observ:str,
                    aluno_nome:str="", aluno_sobrenome:str="", aluno_serie:str="",
-                   beneficiario_tipo:str="aluno", beneficiario_nome:str="", loan_id:int=0) -> int:
+                   beneficiario_tipo:str="aluno", beneficiario_nome:str="", loan_id:int=0) -> dict:
+    """Monta o dict de um movimento (carimbo de agora + responsável do dia)."""
     agora = datetime.now()
-    return inserir_movimento({
+    return {
         "timestamp": agora.isoformat(timespec='seconds'),
         "data": agora.strftime('%d/%m/%Y'),
         "hora": agora.strftime('%H:%M:%S'),
@@ -493,7 +1197,38 @@ def _base_registro(tipo:str, item_nome:str, categoria:str, quantidade:int, prev_
         "beneficiario_tipo": beneficiario_tipo,
         "beneficiario_nome": beneficiario_nome,
         "loan_id": int(loan_id or 0),
-    })
+    }
+
+def _base_registro(tipo:str, item_nome:str, categoria:str, quantidade:int, prev_dev:datetime|None, observ:str,
+                   aluno_nome:str="", aluno_sobrenome:str="", aluno_serie:str="",
+                   beneficiario_tipo:str="aluno", beneficiario_nome:str="", loan_id:int=0,
+                   cadastrar_aluno:bool=False) -> int:
+    aluno = (aluno_nome.strip(), aluno_sobrenome.strip(), aluno_serie.strip()) if cadastrar_aluno else None
+    return inserir_movimento(_novo_registro(tipo, item_nome, categoria, quantidade, prev_dev, observ,
+                                            aluno_nome, aluno_sobrenome, aluno_serie,
+                                            beneficiario_tipo, beneficiario_nome, loan_id), aluno)
+
+def devolucoes_do_beneficiario(pendentes: list[dict], sel: dict, observ: str) -> list[dict]:
+    """Uma Devolução por empréstimo pendente do mesmo beneficiário de `sel` (_benef_key),
+       com a quantidade ainda pendente e o loan_id do empréstimo, para um único inserir_movimento."""
+    chave = _benef_key(sel)
+    return [
+        _novo_registro(
+            tipo="Devolucao",
+            item_nome=r["item_nome"],
+            categoria=r["categoria"],
+            quantidade=int(r["q_pendente"]),
+            prev_dev=None,
+            observ=observ,
+            aluno_nome=r.get("aluno_nome","") or "",
+            aluno_sobrenome=r.get("aluno_sobrenome","") or "",
+            aluno_serie=r.get("aluno_serie","") or "",
+            beneficiario_tipo=r.get("beneficiario_tipo","") or "",
+            beneficiario_nome=r.get("beneficiario_nome","") or "",
+            loan_id=int(r["loan_id"]),
+        )
+        for r in pendentes if _benef_key(r) == chave
+    ]
 
 # ------ Aba: Empréstimo Aluno ------
 with abas[0]:
@@ -502,12 +1237,7 @@ with abas[0]:
     col1, col2 = st.columns([2, 1])
     with col1:
         # labels com categoria
-        labels = {}
-        if not dfi.empty:
-            for r in dfi.itertuples(index=False):
-                disp = int(saldos.loc[saldos['item_nome']==r.item_nome,'disponivel'].values[0]) if (saldos['item_nome']==r.item_nome).any() else int(r.quant_total)
-                nome_visivel = (r.titulo or r.item_nome)
-                labels[r.item_nome] = f"[{r.categoria or 'Livro'}] {nome_visivel} (disp: {disp})"
+        labels = item_labels
         escolha = st.selectbox("Item", options=list(labels.keys()) if labels else [], format_func=lambda k: labels.get(k, k), index=None, key="sel_item_aluno")
         quantidade = st.number_input("Quantidade", min_value=1, value=1, key="qtd_aluno")
         dias = st.number_input("Prazo (dias)", min_value=1, max_value=60, value=7, key="prazo_aluno")
@@ -515,15 +1245,12 @@ with abas[0]:
         st.caption(f"Prev. devolução: {prev_dev.strftime('%d/%m/%Y')}")
 
         st.markdown("### Aluno")
-        aluno_sel = st.selectbox("Aluno (autocomplete)", alunos_options if alunos_options else [""], index=None, placeholder="Buscar aluno já cadastrado...", key="autocomp_aluno")
+        # a opção é o índice do aluno: o preenchimento vem da tupla, sem re-parsear o rótulo
+        aluno_sel = st.selectbox("Aluno (autocomplete)", range(len(alunos_options)), format_func=lambda i: alunos_options[i],
+                                 index=None, placeholder="Buscar aluno já cadastrado...", key="autocomp_aluno")
         nome_pref = sobrenome_pref = serie_pref = ""
-        if aluno_sel:
-            try:
-                nome_pref, rest = aluno_sel.split(" ", 1)
-                if "—" in rest:
-                    sobrenome_pref, serie_pref = [p.strip() for p in rest.split("—", 1)]
-            except Exception:
-                nome_pref = aluno_sel
+        if aluno_sel is not None:
+            nome_pref, sobrenome_pref, serie_pref = alunos_rows[aluno_sel]
         c1,c2,c3 = st.columns(3)
         with c1: nome = st.text_input("Nome *", value=nome_pref, key="aluno_nome")
         with c2: sobrenome = st.text_input("Sobrenome *", value=sobrenome_pref, key="aluno_sobrenome")
@@ -533,13 +1260,7 @@ with abas[0]:
     with col2:
         pode = bool(escolha) and nome.strip() and sobrenome.strip() and serie.strip() and quantidade>0
         if st.button("✅ Registrar Empréstimo", use_container_width=True, disabled=not pode, key="btn_emp_aluno"):
-            if nome.strip() or sobrenome.strip():
-                with get_conn() as con:
-                    con.execute("INSERT OR IGNORE INTO alunos (nome,sobrenome,serie) VALUES (?,?,?)", (nome.strip(), sobrenome.strip(), serie.strip()))
-                    con.commit()
-                df_alunos.clear()
-            cat_sel = dfi.loc[dfi["item_nome"]==escolha, "categoria"].values
-            categoria_item = (cat_sel[0] if len(cat_sel) else "Livro")
+            categoria_item = categoria_map.get(escolha, "Livro")
             _base_registro(
                 tipo="Emprestimo",
                 item_nome=escolha,
@@ -549,12 +1270,14 @@ with abas[0]:
                 observ=observ,
                 aluno_nome=nome, aluno_sobrenome=sobrenome, aluno_serie=serie,
                 beneficiario_tipo="aluno", beneficiario_nome="",
+                # aluno novo: cadastro + empréstimo num só commit; já cadastrado: nem tenta o INSERT
+                cadastrar_aluno=(nome.strip(), sobrenome.strip(), serie.strip()) not in alunos_conhecidos,
             )
             st.success("Empréstimo registrado.")
 
     st.markdown("---")
     st.caption("Saldos do catálogo")
-    st.dataframe(status_itens(df_mov()), use_container_width=True, hide_index=True)
+    tabela_paginada(status_atual(), key="pg_saldos_aluno")
 
 # ------ Aba: Empréstimo Professor ------
 with abas[1]:
@@ -568,35 +1291,31 @@ with abas[1]:
         st.caption(f"Prev. devolução: {prev_p.strftime('%d/%m/%Y')}")
 
         st.markdown("### Seleção de itens")
-        labels = {
-            r.item_nome: f"[{r.categoria or 'Livro'}] {r.titulo or r.item_nome} "
-                         f"(disp: {int(saldos.loc[saldos['item_nome']==r.item_nome,'disponivel'].values[0]) if (saldos['item_nome']==r.item_nome).any() else int(r.quant_total)})"
-            for r in dfi.itertuples(index=False)
-        }
+        labels = item_labels
         escolhidos = st.multiselect("Escolha itens", options=list(labels.keys()), format_func=lambda k: labels.get(k,k), key="multi_prof")
 
         qts = {}
         for k in escolhidos:
-            disp = int(saldos.loc[saldos['item_nome']==k,'disponivel'].values[0]) if (saldos['item_nome']==k).any() \
-                   else int(dfi.loc[dfi['item_nome']==k,'quant_total'].values[0])
+            disp = int(disp_map[k]) if k in disp_map else int(qtot_map[k])
             qts[k] = st.number_input(f"Quantidade para {labels[k]}", min_value=1, max_value=max(1, disp if disp>0 else 1),
                                      value=min(1, disp) if disp>0 else 1, key=f"q_{k}")
         observ_p = st.text_input("Observações gerais", key="obs_prof")
 
         pode = prof.strip() and len(escolhidos)>0 and all((qts[k] or 0)>0 for k in escolhidos)
         if st.button("✅ Registrar Empréstimos do Professor", use_container_width=True, disabled=not pode, key="btn_emp_prof"):
-            for k in escolhidos:
-                cat_sel = dfi.loc[dfi["item_nome"]==k, "categoria"].values
-                categoria_item = (cat_sel[0] if len(cat_sel) else "Livro")
-                _base_registro(
+            # todos os itens do professor num só lote/commit
+            inserir_movimento([
+                _novo_registro(
                     tipo="Emprestimo",
                     item_nome=k,
-                    categoria=categoria_item,
+                    categoria=categoria_map.get(k, "Livro"),
                     quantidade=int(qts[k]),
                     prev_dev=prev_p,
                     observ=observ_p,
                     beneficiario_tipo="professor", beneficiario_nome=prof.strip(),
                 )
+                for k in escolhidos
+            ])
             st.success(f"Empréstimos registrados para {prof}.")
 
 # ------ Aba: Devolução (por empréstimo) ------
@@ -617,9 +1336,11 @@ with abas[2]:
             atras = "⚠️ ATRASADO " if row["atrasado"] else ""
             return f"{atras}[{cat}] {tit} • {who} • pendente: {int(row['q_pendente'])} • prev: {prev}"
 
-        options = {int(r.loan_id): _label(r) for _, r in pend.iterrows()}
+        # uma passada: registro por loan_id (rótulo e linha escolhida saem do mesmo dict)
+        por_loan = {int(r["loan_id"]): r for r in pend.to_dict("records")}
+        options = {k: _label(r) for k, r in por_loan.items()}
         sel_loan = st.selectbox("Escolha o empréstimo", options=list(options.keys()), format_func=lambda k: options.get(k,str(k)), key="sel_dev_loan")
-        row_sel = pend[pend["loan_id"]==int(sel_loan)].iloc[0]
+        row_sel = por_loan[int(sel_loan)]
         max_dev = int(row_sel["q_pendente"])
         qtd_dev = st.number_input("Quantidade a devolver", min_value=1, max_value=max_dev, value=max_dev, key="qtd_dev")
         observ_d = st.text_input("Observações", key="obs_dev")
@@ -643,9 +1364,17 @@ with abas[2]:
             st.success("Devolução registrada.")
             st.rerun()
 
+        # devolução em lote: todos os pendentes do mesmo beneficiário (um único executemany/commit)
+        mesmos = devolucoes_do_beneficiario(list(por_loan.values()), row_sel, observ_d)
+        if len(mesmos) > 1 and st.button(f"↩️ Devolver todos os {len(mesmos)} empréstimos pendentes deste beneficiário",
+                                         use_container_width=True, key="btn_dev_todos"):
+            inserir_movimento(mesmos)
+            st.success(f"{len(mesmos)} devoluções registradas.")
+            st.rerun()
+
     st.markdown("---")
     st.caption("Saldos atuais por item")
-    st.dataframe(status_itens(df_mov()), use_container_width=True, hide_index=True)
+    tabela_paginada(status_atual(), key="pg_saldos_dev")
 
 # ------ Aba: Catálogo ------
 with abas[3]:
@@ -657,9 +1386,11 @@ with abas[3]:
         up = st.file_uploader("Selecione a planilha do catálogo", type=["xlsx"], key="upload_cat")
         if up is not None:
             try:
-                excel = pd.read_excel(up)
+                # a cada rerun só o cabeçalho + 10 linhas; a leitura completa fica para o import
+                raw = up.getvalue()
+                excel = pd.read_excel(BytesIO(raw), nrows=10)
                 st.write("Pré-visualização (10 linhas):")
-                st.dataframe(excel.head(10), use_container_width=True, hide_index=True)
+                st.dataframe(excel, use_container_width=True, hide_index=True)
                 st.markdown("#### Mapeamento de colunas")
                 cols = ["— ignorar —"] + list(excel.columns)
                 map_titulo   = st.selectbox("Título (Nome do Livro)", cols, index=(cols.index("Nome do Livro") if "Nome do Livro" in cols else 0), key="map_titulo")
@@ -671,28 +1402,17 @@ with abas[3]:
                 map_quant    = st.selectbox("Unidades", cols, index=(cols.index("unidades") if "unidades" in cols else 0), key="map_quant")
 
                 if st.button("📥 Importar catálogo (Livros)", key="btn_import_cat"):
-                    n_ok = 0
-                    for _, r in excel.iterrows():
-                        def pick(c):
-                            return (str(r[c]).strip() if (c and c in excel.columns and pd.notna(r[c])) else "")
-                        campos = {
-                            "titulo": pick(map_titulo) if map_titulo!="— ignorar —" else "",
-                            "autor": pick(map_autor) if map_autor!="— ignorar —" else "",
-                            "editora": pick(map_editora) if map_editora!="— ignorar —" else "",
-                            "genero": pick(map_genero) if map_genero!="— ignorar —" else "",
-                            "isbn": pick(map_isbn) if map_isbn!="— ignorar —" else "",
-                            "edicao": pick(map_edicao) if map_edicao!="— ignorar —" else "",
-                        }
-                        qt = pick(map_quant) if map_quant!="— ignorar —" else ""
-                        try:
-                            qt_i = int(float(qt)) if str(qt).strip()!="" else 1
-                        except Exception:
-                            qt_i = 1
-                        campos["quant_total"] = max(1, qt_i)
-                        campos["item_nome"] = campos["titulo"] or campos["isbn"] or campos["autor"]
-                        campos["categoria"] = "Livro"
-                        upsert_item_catalogo(**campos)
-                        n_ok += 1
+                    ign = lambda c: None if c == "— ignorar —" else c
+                    mapa = {
+                        "titulo": ign(map_titulo), "autor": ign(map_autor), "editora": ign(map_editora),
+                        "genero": ign(map_genero), "isbn": ign(map_isbn), "edicao": ign(map_edicao),
+                        "quant_total": ign(map_quant),
+                    }
+                    # só as colunas mapeadas são lidas da planilha
+                    usadas = {c for c in mapa.values() if c is not None}
+                    excel = pd.read_excel(BytesIO(raw), usecols=lambda c: c in usadas)
+                    linhas = linhas_catalogo_excel(excel, mapa)
+                    n_ok = upsert_itens_bulk(linhas)
                     st.success(f"Importação concluída: {n_ok} livro(s).")
             except Exception as e:
                 st.error(f"Falha ao ler Excel: {e}")
@@ -738,53 +1458,17 @@ with abas[3]:
     st.markdown("---")
     st.markdown("### Editar / Excluir itens existentes")
 
-    # Auxiliares locais
-    def df_itens_full():
-        ensure_migrations()
-        with get_conn() as con:
-            return pd.read_sql_query(
-                "SELECT id,item_nome,categoria,titulo,autor,editora,genero,isbn,edicao,quant_total FROM itens",
-                con,
-            )
-
-    def update_item(item_id:int, **fields):
-        if not fields:
-            return
-        ensure_migrations()
-        cols = [k for k in ["item_nome","categoria","titulo","autor","editora","genero","isbn","edicao","quant_total"] if k in fields]
-        if not cols:
-            return
-        set_clause = ",".join([f"{k}=?" for k in cols])
-        vals = [fields[k] for k in cols] + [item_id]
-        with get_conn() as con:
-            con.execute(f"UPDATE itens SET {set_clause} WHERE id=?", vals)
-            con.commit()
-        df_itens.clear()
-
-    def delete_item(item_id:int):
-        ensure_migrations()
-        with get_conn() as con:
-            con.execute("DELETE FROM itens WHERE id=?", (item_id,))
-            con.commit()
-        df_itens.clear()
-
     dff = df_itens_full()
     if dff.empty:
         st.info("Catálogo vazio.")
     else:
-        labels = {
-            int(r.id): f"[{r.categoria or 'Livro'}] {r.titulo or r.item_nome} — ISBN: {r.isbn or 's/ISBN'} (Unid: {int(r.quant_total)})"
-            for r in dff.itertuples(index=False)
-        }
+        labels = rotulos_edicao()
         sel_id = st.selectbox("Escolha um item do catálogo", options=list(labels.keys()),
                               format_func=lambda i: labels.get(int(i), str(i)), key="sel_edit_item")
-        item_row = dff[dff["id"]==int(sel_id)].iloc[0]
+        item_row = dff.loc[int(sel_id)]
 
         # estoque emprestado para bloqueio de exclusão
-        try:
-            emp_q = int(saldos.loc[saldos["item_nome"]==item_row["item_nome"], "emprestado"].values[0])
-        except Exception:
-            emp_q = 0
+        emp_q = int(emp_map.get(item_row["item_nome"], 0))
 
         with st.form("form_edit_item"):
             c1,c2 = st.columns([2,1])
@@ -827,26 +1511,12 @@ with abas[3]:
 
     st.markdown("---")
     st.caption("Catálogo atual")
-    st.dataframe(df_itens(), use_container_width=True, hide_index=True)
+    # lido uma vez (pós-escritas desta execução); a exportação usa o .xlsx cacheado por versão
+    dcurr = df_itens()
+    tabela_paginada(dcurr, key="pg_catalogo")
 
     # Exportar catálogo
-    buf = BytesIO()
-    try:
-        with pd.ExcelWriter(buf, engine="xlsxwriter") as w:
-            dcurr = df_itens()
-            if dcurr.empty:
-                pd.DataFrame([{ "Info": "Catálogo vazio" }]).to_excel(w, sheet_name='catalogo', index=False)
-            else:
-                dcurr.to_excel(w, sheet_name='catalogo', index=False)
-    except Exception:
-        with pd.ExcelWriter(buf, engine="openpyxl") as w:
-            dcurr = df_itens()
-            if dcurr.empty:
-                pd.DataFrame([{ "Info": "Catálogo vazio" }]).to_excel(w, sheet_name='catalogo', index=False)
-            else:
-                dcurr.to_excel(w, sheet_name='catalogo', index=False)
-    buf.seek(0)
-    st.download_button("⬇️ Exportar catálogo (.xlsx)", data=buf.getvalue(),
+    st.download_button("⬇️ Exportar catálogo (.xlsx)", data=xlsx_catalogo(),
                        file_name="catalogo_sala_leitura.xlsx",
                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", key="dl_cat")
 
@@ -867,20 +1537,21 @@ with abas[4]:
         with colf[3]:
             somente_prof = st.checkbox("Somente Professor", key="f_prof")
 
-        view = dfm_now.copy()
-        if filtro_nome:
-            mask = view['aluno_nome'].fillna("").str.contains(filtro_nome, case=False) | \
-                   view['aluno_sobrenome'].fillna("").str.contains(filtro_nome, case=False) | \
-                   view['beneficiario_nome'].fillna("").str.contains(filtro_nome, case=False)
-            view = view[mask]
-        if filtro_item:
-            view = view[view['item_nome'].fillna("").str.contains(filtro_item, case=False)]
-        if filtro_tipo != "Todos":
-            view = view[view['tipo']==filtro_tipo]
-        if somente_prof:
-            view = view[view['beneficiario_tipo']=="professor"]
-
-        st.dataframe(view.sort_values("timestamp", ascending=False), use_container_width=True, hide_index=True)
+        view = filtrar_movimentos(dfm_now, filtro_nome, filtro_item, filtro_tipo, somente_prof)
+
+        # só as `limite` mais recentes vão para o navegador (Arrow + tabela são lineares no nº de linhas)
+        # "Mostrar mais" vale só para os filtros em que foi clicado: outra busca volta ao primeiro bloco
+        filtros = (filtro_nome, filtro_item, filtro_tipo, somente_prof)
+        chave, limite = st.session_state.get("hist_limite", (filtros, HIST_LINHAS))
+        if chave != filtros:
+            limite = HIST_LINHAS
+        hist = view[COLS_MOV]  # df_mov já vem do mais recente para o mais antigo
+        st.dataframe(hist.head(limite), use_container_width=True, hide_index=True)
+        if len(hist) > limite:
+            st.caption(f"Mostrando {limite} de {len(hist)} movimentações.")
+            if st.button("Mostrar mais", key="btn_hist_mais"):
+                st.session_state["hist_limite"] = (filtros, limite + HIST_LINHAS)
+                st.rerun()
 
         st.markdown("---")
         st.subheader("📤 Exportar (período)")
@@ -894,45 +1565,14 @@ with abas[4]:
             incluir_status = st.checkbox("Incluir aba 'status_atual'", value=True, key="exp_status")
 
         if st.button("Gerar planilha de movimentações (.xlsx)", key="btn_exp_mov"):
-            per = view.copy()
-            per['ts'] = pd.to_datetime(per['timestamp'], errors='coerce')
-            ini = datetime.combine(data_ini, datetime.min.time())
-            fim = datetime.combine(data_fim, datetime.max.time())
-            per = per[(per['ts'] >= ini) & (per['ts'] <= fim)].drop(columns=['ts'])
-
-            cols_novas = [
-                ("Data","data"),("Hora","hora"),("Tipo","tipo"),("Item","item_nome"),("Categoria","categoria"),
-                ("Quantidade","quantidade"),("BeneficiárioTipo","beneficiario_tipo"),("BeneficiárioNome","beneficiario_nome"),
-                ("Nome","aluno_nome"),("Sobrenome","aluno_sobrenome"),("Série","aluno_serie"),
-                ("Prev. Devolução","prev_devolucao"),("Responsável","responsavel"),("Obs.","observacoes"),
-            ]
-            per_export = per[[c for _,c in cols_novas]].rename(columns=dict(cols_novas)) if not per.empty else pd.DataFrame(columns=[k for k,_ in cols_novas])
-            buffer = BytesIO()
-            try:
-                with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-                    order_cols = [c for c in ['Data','Hora'] if c in per_export.columns]
-                    per_sorted = per_export.sort_values(order_cols, ascending=True) if order_cols else per_export
-                    if per_sorted.empty:
-                        pd.DataFrame([{ "Info": f"Sem registros entre {data_ini:%d/%m/%Y} e {data_fim:%d/%m/%Y}" }]).to_excel(writer, sheet_name='emprestimos', index=False)
-                    else:
-                        per_sorted.to_excel(writer, sheet_name='emprestimos', index=False)
-                    if incluir_status:
-                        sa = status_itens(df_mov())
-                        sa.to_excel(writer, sheet_name='status_atual', index=False)
-            except Exception:
-                with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-                    order_cols = [c for c in ['Data','Hora'] if c in per_export.columns]
-                    per_sorted = per_export.sort_values(order_cols, ascending=True) if order_cols else per_export
-                    if per_sorted.empty:
-                        pd.DataFrame([{ "Info": f"Sem registros entre {data_ini:%d/%m/%Y} e {data_fim:%d/%m/%Y}" }]).to_excel(writer, sheet_name='emprestimos', index=False)
-                    else:
-                        per_sorted.to_excel(writer, sheet_name='emprestimos', index=False)
-                    if incluir_status:
-                        sa = status_itens(df_mov())
-                        sa.to_excel(writer, sheet_name='status_atual', index=False)
-            buffer.seek(0)
+            # período resolvido no SQLite; os filtros da consulta valem também para o export
+            ini_iso = datetime.combine(data_ini, datetime.min.time()).isoformat()
+            fim_iso = datetime.combine(data_fim, datetime.max.time()).isoformat()
+            xlsx = gerar_xlsx_movimentos(ini_iso, fim_iso, filtro_nome, filtro_item, filtro_tipo, somente_prof,
+                                         incluir_status, f"Sem registros entre {data_ini:%d/%m/%Y} e {data_fim:%d/%m/%Y}",
+                                         versao_db())
             nome = f"movimentacoes_{data_ini:%Y%m%d}_{data_fim:%Y%m%d}.xlsx"
-            st.download_button("⬇️ Baixar movimentações", data=buffer.getvalue(), file_name=nome,
+            st.download_button("⬇️ Baixar movimentações", data=xlsx, file_name=nome,
                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", key="dl_mov")
 
         st.markdown("### 📥 Exportar Empréstimos Pendentes")
@@ -941,23 +1581,7 @@ with abas[4]:
             st.caption("Não há pendências no momento.")
         else:
             # planilha de pendentes
-            bufp = BytesIO()
-            with pd.ExcelWriter(bufp, engine="xlsxwriter") as w:
-                export_cols = [
-                    ("LoanID","loan_id"),
-                    ("Data","data"),("Hora","hora"),
-                    ("Categoria","categoria"),("Título/Item","titulo"),
-                    ("Item (chave)","item_nome"),
-                    ("Qtd Emp.","q_emprestado"),("Qtd Dev.","q_devolvido"),("Qtd Pendente","q_pendente"),
-                    ("Prev. Devolução","prev_devolucao"),
-                    ("Tipo Beneficiário","beneficiario_tipo"),
-                    ("Nome Beneficiário","beneficiario_nome"),
-                    ("Aluno Nome","aluno_nome"),("Aluno Sobrenome","aluno_sobrenome"),("Série","aluno_serie"),
-                    ("Atrasado","atrasado"),
-                ]
-                dfexp = pend[[c for _,c in export_cols]].rename(columns=dict(export_cols))
-                dfexp.to_excel(w, sheet_name="pendentes", index=False)
-            bufp.seek(0)
-            st.download_button("⬇️ Baixar pendentes (.xlsx)", data=bufp.getvalue(),
+            dfexp = pend[EXPORT_PEND_COLUNAS].rename(columns=EXPORT_PEND_RENAME)
+            st.download_button("⬇️ Baixar pendentes (.xlsx)", data=xlsx_bytes({"pendentes": dfexp}),
                                file_name="emprestimos_pendentes.xlsx",
                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", key="dl_pendentes")
@@ -0,0 +1,425 @@
+import importlib.util
+import sqlite3
+import threading
+from contextlib import ExitStack
+from datetime import date, datetime
+from io import BytesIO
+from pathlib import Path
+
+import pandas as pd
+import streamlit as st
+
+APP = Path(__file__).resolve().parents[1] / "app.py"
+
+
+def _carrega_app(tmp_path, monkeypatch):
+    """Importa app.py (modo bare do Streamlit) com o banco num diretório temporário."""
+    monkeypatch.chdir(tmp_path)
+    # caches do Streamlit são globais ao processo: sem isso a conexão do teste anterior voltaria
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    spec = importlib.util.spec_from_file_location("app_teste", APP)
+    app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app)
+    return app
+
+
+def _emprestimo(i):
+    return {"timestamp": f"2024-01-01T10:{i // 60 % 60:02d}:{i % 60:02d}", "data": "01/01/2024",
+            "hora": "10:00:00", "tipo": "Emprestimo", "item_nome": f"Livro {i % 7}",
+            "categoria": "Livro", "beneficiario_tipo": "professor", "beneficiario_nome": f"Prof {i % 3}",
+            "quantidade": 1}
+
+
+def test_df_mov_concorrente_com_insercao(tmp_path, monkeypatch):
+    app = _carrega_app(tmp_path, monkeypatch)
+    parar = threading.Event()
+    erros = []
+
+    def escritor():
+        try:
+            for lote in range(40):
+                app.inserir_movimentos_bulk([_emprestimo(lote * 5 + k) for k in range(5)])
+        except Exception as e:  # pragma: no cover - falha reportada abaixo
+            erros.append(e)
+        finally:
+            parar.set()
+
+    t = threading.Thread(target=escritor)
+    t.start()
+    while not parar.is_set():
+        app.df_mov()
+    t.join()
+    assert not erros, erros
+
+    df = app.df_mov()
+    assert len(df) == 200
+    # nenhuma linha lida antes do UPDATE loan_id = id do próprio lote
+    assert (df["loan_id"] > 0).all()
+    con = sqlite3.connect(tmp_path / "sala_leitura.db")
+    try:
+        cheio = app._normaliza_mov(pd.read_sql_query(app.SQL_SELECT_MOV + app.ORDEM_MOV, con))
+    finally:
+        con.close()
+    pd.testing.assert_frame_equal(df, cheio)
+
+
+def test_df_mov_no_meio_do_lote_nao_congela_loan_id(tmp_path, monkeypatch):
+    app = _carrega_app(tmp_path, monkeypatch)
+    app.inserir_movimentos_bulk([_emprestimo(0)])
+    app.df_mov()
+    with app.trava_escrita(), app.get_conn() as con:
+        # lote pela metade: INSERT feito, UPDATE loan_id = id ainda não
+        con.execute("BEGIN IMMEDIATE")
+        con.execute("INSERT INTO movimentacoes (timestamp, tipo, item_nome, quantidade, loan_id) "
+                    "VALUES ('2024-02-01T10:00:00', 'Emprestimo', 'Livro 1', 1, 0)")
+        lidos = []
+        leitor = threading.Thread(target=lambda: (app._invalida_mov(), lidos.append(len(app.df_mov()))))
+        leitor.start()
+        leitor.join()
+        assert lidos == [1]
+        con.execute("UPDATE movimentacoes SET loan_id = id WHERE loan_id = 0")
+        con.commit()
+    app._invalida_mov()
+    df = app.df_mov()
+    assert len(df) == 2
+    assert (df["loan_id"] > 0).all()
+
+
+def test_leitura_nao_confirma_transacao_de_escritor(tmp_path, monkeypatch):
+    app = _carrega_app(tmp_path, monkeypatch)
+    with app.trava_escrita(), app.get_conn() as con:
+        con.execute("BEGIN IMMEDIATE")
+        con.execute("INSERT INTO alunos (nome, sobrenome, serie) VALUES ('A', 'B', '1')")
+        # leitura de outra sessão no meio da transação: não vê a linha nem confirma nada
+        app._df_alunos.clear()
+        lidos = []
+        leitor = threading.Thread(target=lambda: lidos.append(len(app.df_alunos())))
+        leitor.start()
+        leitor.join()
+        assert lidos == [0]
+        con.rollback()
+    con = sqlite3.connect(tmp_path / "sala_leitura.db")
+    try:
+        assert con.execute("SELECT COUNT(*) FROM alunos").fetchone() == (0,)
+    finally:
+        con.close()
+
+
+def test_df_mov_empate_de_timestamp_mais_novo_primeiro(tmp_path, monkeypatch):
+    app = _carrega_app(tmp_path, monkeypatch)
+    app.inserir_movimentos_bulk([_emprestimo(0)])
+    app.df_mov()
+    # mesmo segundo: o de id maior vem primeiro, tanto anexado (incremental) quanto relido
+    mesmo = [{**_emprestimo(1), "item_nome": nome} for nome in ("Primeiro", "Segundo")]
+    app.inserir_movimentos_bulk(mesmo)
+    incremental = app.df_mov()
+    assert incremental["item_nome"].tolist()[:2] == ["Segundo", "Primeiro"]
+    app.inserir_movimentos_bulk([{**_emprestimo(1), "item_nome": "Terceiro"}])
+    relido = app.df_mov()  # empata com o frame já lido: releitura completa
+    assert relido["item_nome"].tolist()[:3] == ["Terceiro", "Segundo", "Primeiro"]
+
+
+def test_xlsx_movimentos_cabecalho_com_rotulos(tmp_path, monkeypatch):
+    app = _carrega_app(tmp_path, monkeypatch)
+    app.inserir_movimentos_bulk([_emprestimo(0)])
+    dados = app.gerar_xlsx_movimentos("2024-01-01T00:00:00", "2024-01-02T00:00:00", "", "", "Todos",
+                                      False, False, "Sem movimentações", app.versao_db())
+    aba = pd.read_excel(BytesIO(dados), sheet_name="emprestimos", header=None)
+    assert aba.iloc[0].tolist() == app.EXPORT_MOV_ROTULOS
+    assert aba.iloc[0, 0] == "Data" and aba.iloc[1, 3] == "Livro 0"
+
+
+def test_migracao_devolucao_zerada_sem_emprestimo_disponivel(tmp_path, monkeypatch):
+    app = _carrega_app(tmp_path, monkeypatch)
+    con = sqlite3.connect(tmp_path / "sala_leitura.db")
+    # histórico antigo, sem loan_id: 1 empréstimo, uma devolução que o esgota e outra zerada
+    for ts, tipo, qtd in [("2024-01-01T10:00:00", "Emprestimo", 1),
+                          ("2024-01-02T10:00:00", "Devolucao", 1),
+                          ("2024-01-03T10:00:00", "Devolucao", 0)]:
+        con.execute("INSERT INTO movimentacoes (timestamp, tipo, item_nome, quantidade, beneficiario_tipo, "
+                    "beneficiario_nome) VALUES (?, ?, 'Livro 0', ?, 'professor', 'Prof 0')", (ts, tipo, qtd))
+    con.commit()
+    con.close()
+    app.ensure_migrations.clear()
+    app.ensure_migrations()
+    con = sqlite3.connect(tmp_path / "sala_leitura.db")
+    try:
+        devs = con.execute("SELECT timestamp, quantidade, loan_id FROM movimentacoes "
+                           "WHERE tipo = 'Devolucao' ORDER BY timestamp").fetchall()
+    finally:
+        con.close()
+    # a primeira é vinculada ao empréstimo; a zerada fica como estava (sem loan_id)
+    assert devs[0][:2] == ("2024-01-02T10:00:00", 1) and devs[0][2] > 0
+    assert devs[1] == ("2024-01-03T10:00:00", 0, None)
+
+
+def test_status_itens_com_item_nome_repetido(tmp_path, monkeypatch):
+    app = _carrega_app(tmp_path, monkeypatch)
+    con = sqlite3.connect(tmp_path / "sala_leitura.db")
+    # bancos antigos: vários itens com item_nome NULL (viram "" no catálogo)
+    con.execute("INSERT INTO itens (item_nome, titulo, quant_total) "
+                "VALUES (NULL, 'A', 2), (NULL, 'B', 1), ('Livro 0', 'Livro 0', 1)")
+    con.commit()
+    con.close()
+    app.inserir_movimentos_bulk([_emprestimo(0)])
+    st.cache_data.clear()
+    status = app.status_itens().set_index("titulo")
+    assert status.loc["Livro 0", "status"] == "Emprestado"
+    assert status.loc["Livro 0", "disponivel"] == 0
+    assert {"A", "B"} <= set(status.index)
+
+
+CATALOGO_INICIAL = [
+    {"item_nome": "Dom Casmurro", "titulo": "Dom Casmurro", "autor": "Machado", "isbn": "111"},
+    {"item_nome": "Iracema", "titulo": "Iracema", "autor": "Alencar", "edicao": "2"},
+    {"item_nome": "Xadrez", "categoria": "Jogo", "quant_total": 2},
+]
+
+
+def _catalogo_apos(tmp_path, monkeypatch, pasta, linhas, em_lote):
+    """Catálogo (sem a coluna id) depois de importar `linhas` em lote ou item a item."""
+    (tmp_path / pasta).mkdir()
+    app = _carrega_app(tmp_path / pasta, monkeypatch)
+    app.upsert_itens_bulk(CATALOGO_INICIAL)
+    erro = None
+    try:
+        if em_lote:
+            app.upsert_itens_bulk(linhas)
+        else:
+            for campos in linhas:
+                app.upsert_item_catalogo(**campos)
+    except sqlite3.IntegrityError as e:
+        erro = e
+    con = sqlite3.connect(tmp_path / pasta / "sala_leitura.db")
+    try:
+        itens = con.execute(f"SELECT id,{','.join(app.COLS_ITENS)} FROM itens ORDER BY id").fetchall()
+    finally:
+        con.close()
+    return itens, erro
+
+
+def test_upsert_itens_bulk_igual_ao_item_a_item(tmp_path, monkeypatch):
+    linhas = [
+        # ISBN repetido na mesma planilha: a segunda linha atualiza a primeira
+        {"item_nome": "Memórias", "titulo": "Memórias", "autor": "Machado", "isbn": "222", "quant_total": 1},
+        {"item_nome": "Memórias (2ª)", "titulo": "Memórias", "autor": "Machado", "isbn": "222", "quant_total": 3},
+        # ISBN já no catálogo, renomeando o item
+        {"item_nome": "Dom Casmurro (capa dura)", "titulo": "Dom Casmurro", "autor": "Machado", "isbn": "111"},
+        # sem ISBN: chave titulo+autor+edição
+        {"titulo": "Iracema", "autor": "Alencar", "edicao": "2", "quant_total": 5},
+        {"item_nome": "Iracema (1ª)", "titulo": "Iracema", "autor": "Alencar", "quant_total": 1},
+        # casa com o item inserido acima no mesmo lote (edição vazia)
+        {"item_nome": "Iracema (s/ ed.)", "titulo": "Iracema", "autor": "Alencar", "quant_total": 4},
+        # Jogo: chave item_nome
+        {"item_nome": "Xadrez", "categoria": "Jogo", "quant_total": 7},
+        {"item_nome": "Dama", "categoria": "Jogo"},
+    ]
+    lote, erro_lote = _catalogo_apos(tmp_path, monkeypatch, "lote", linhas, True)
+    a_item, erro_item = _catalogo_apos(tmp_path, monkeypatch, "item", linhas, False)
+    assert erro_lote is None and erro_item is None
+    assert lote == a_item
+    assert len(lote) == 6
+
+
+def test_upsert_itens_bulk_conflito_de_item_nome(tmp_path, monkeypatch):
+    # outro ISBN com o item_nome de um item existente: o UNIQUE do SQLite recusa
+    linhas = [
+        {"item_nome": "Novo", "titulo": "Novo", "autor": "X", "isbn": "333"},
+        {"item_nome": "Dom Casmurro", "titulo": "Outro", "autor": "Y", "isbn": "444"},
+    ]
+    lote, erro_lote = _catalogo_apos(tmp_path, monkeypatch, "lote", linhas, True)
+    a_item, erro_item = _catalogo_apos(tmp_path, monkeypatch, "item", linhas, False)
+    assert erro_lote is not None and erro_item is not None
+    # o lote é uma transação só: nada da planilha fica gravado
+    assert [r[1] for r in lote] == ["Dom Casmurro", "Iracema", "Xadrez"]
+    assert [r[1] for r in a_item] == ["Dom Casmurro", "Iracema", "Xadrez", "Novo"]
+
+
+def test_upsert_itens_bulk_troca_de_nomes(tmp_path, monkeypatch):
+    # troca de item_nome entre dois itens via nome temporário: válida linha a linha
+    linhas = [
+        {"item_nome": "tmp", "titulo": "Dom Casmurro", "autor": "Machado", "isbn": "111"},
+        {"item_nome": "Dom Casmurro", "titulo": "Iracema", "autor": "Alencar", "edicao": "2"},
+        {"item_nome": "Iracema", "titulo": "Dom Casmurro", "autor": "Machado", "isbn": "111"},
+    ]
+    lote, erro_lote = _catalogo_apos(tmp_path, monkeypatch, "lote", linhas, True)
+    a_item, erro_item = _catalogo_apos(tmp_path, monkeypatch, "item", linhas, False)
+    assert erro_lote is None and erro_item is None
+    assert lote == a_item
+    assert [r[1] for r in lote] == ["Iracema", "Dom Casmurro", "Xadrez"]
+
+
+def test_busca_da_consulta_e_do_export_com_a_mesma_regra(tmp_path, monkeypatch):
+    app = _carrega_app(tmp_path, monkeypatch)
+    app.inserir_movimentos_bulk([{**_emprestimo(0), "beneficiario_nome": "Prof Straße", "item_nome": "ÉPICO"}])
+    for nome, item in [("STRASSE", ""), ("straße", ""), ("", "épico"), ("", "Épi")]:
+        tela = app.filtrar_movimentos(app.df_mov(), filtro_nome=nome, filtro_item=item)
+        sql, params = app.sql_export_movimentos(app.EXPORT_MOV_COLUNAS, "2024-01-01T00:00:00",
+                                                "2024-01-02T00:00:00", nome, item)
+        with app.conn_leitura() as con:
+            export = con.execute(sql, params).fetchall()
+        assert len(tela) == len(export) == 1
+
+
+def _linhas_catalogo_por_linha(excel, mapa):
+    """Conversão antiga (iterrows), referência para linhas_catalogo_excel."""
+    linhas = []
+    for _, r in excel.iterrows():
+        def pick(c):
+            return str(r[c]).strip() if (c and c in excel.columns and pd.notna(r[c])) else ""
+        campos = {k: pick(mapa.get(k)) for k in ("titulo", "autor", "editora", "genero", "isbn", "edicao")}
+        qt = pick(mapa.get("quant_total"))
+        try:
+            qt_i = int(float(qt)) if qt != "" else 1
+        except Exception:
+            qt_i = 1
+        campos["quant_total"] = max(1, qt_i)
+        campos["item_nome"] = campos["titulo"] or campos["isbn"] or campos["autor"]
+        campos["categoria"] = "Livro"
+        linhas.append(campos)
+    return linhas
+
+
+def test_linhas_catalogo_excel_igual_a_conversao_por_linha(tmp_path, monkeypatch):
+    app = _carrega_app(tmp_path, monkeypatch)
+    nan = float("nan")
+    excel = pd.DataFrame({
+        "Título": ["  Dom Casmurro ", None, "", nan, "Iracema", "Memórias"],
+        "Autor": ["Machado", "Alencar", None, " Anônimo ", nan, "Machado"],
+        "ISBN": ["111", "222", nan, None, 9788535.0, " 333 "],
+        "Número": [2, None, "3ª", nan, 1.0, ""],
+        "Unidades": [3.9, "abc", float("inf"), -2, None, " 4 "],
+        "Gênero": [nan, "Romance", "", None, "Drama", nan],
+    })
+    mapa = {"titulo": "Título", "autor": "Autor", "editora": None, "genero": "Gênero",
+            "isbn": "ISBN", "edicao": "Número", "quant_total": "Unidades"}
+    linhas = app.linhas_catalogo_excel(excel, mapa)
+    assert linhas == _linhas_catalogo_por_linha(excel, mapa)
+    assert [r["quant_total"] for r in linhas] == [3, 1, 1, 1, 1, 4]
+    assert [r["item_nome"] for r in linhas] == ["Dom Casmurro", "222", "", "Anônimo", "Iracema", "Memórias"]
+    # coluna mapeada que não veio na planilha: campo vazio
+    assert all(r["editora"] == "" for r in app.linhas_catalogo_excel(excel, {**mapa, "editora": "Editora"}))
+
+
+def _ultimo_por_item(tmp_path):
+    """Referência da versão em pandas: sort_values('timestamp') + groupby().tail(1), com os
+       empates de timestamp resolvidos pelo id (o mais novo vence)."""
+    con = sqlite3.connect(tmp_path / "sala_leitura.db")
+    try:
+        df = pd.read_sql_query("SELECT * FROM movimentacoes ORDER BY id", con)
+    finally:
+        con.close()
+    ult = df.sort_values("timestamp", kind="stable").groupby("item_nome").tail(1)
+    return {r.item_nome: ("Emprestado" if r.tipo.lower().startswith("emprest") else "Disponível",
+                          f"{r.aluno_nome} {r.aluno_sobrenome}".strip())
+            for r in ult.itertuples()}
+
+
+def test_ultimo_mov_acompanha_insercao_exclusao_e_edicao(tmp_path, monkeypatch):
+    app = _carrega_app(tmp_path, monkeypatch)
+    def mov(ts, tipo, item, aluno):
+        return {"timestamp": ts, "tipo": tipo, "item_nome": item, "categoria": "Livro",
+                "beneficiario_tipo": "aluno", "aluno_nome": aluno, "aluno_sobrenome": "S",
+                "aluno_serie": "5A", "quantidade": 1}
+    app.inserir_movimentos_bulk([
+        mov("2024-01-01T10:00:00", "Emprestimo", "A", "Ana"),
+        mov("2024-01-02T10:00:00", "Devolucao", "A", "Ana"),
+        # empate de timestamp: o id maior é o último
+        mov("2024-01-03T10:00:00", "Emprestimo", "B", "Bia"),
+        mov("2024-01-03T10:00:00", "Devolucao", "B", "Bia"),
+        mov("2024-01-04T10:00:00", "Emprestimo", "C", "Caio"),
+        mov("2024-01-01T09:00:00", "Emprestimo", "C", "Duda"),  # inserido fora de ordem
+    ])
+    def confere():
+        status = app.status_itens().set_index("item_nome")
+        obtido = {k: (r.status, r.aluno) for k, r in status.iterrows()}
+        assert obtido == _ultimo_por_item(tmp_path)
+
+    confere()
+    con = sqlite3.connect(tmp_path / "sala_leitura.db")
+    try:
+        # exclusão do último de A: volta o empréstimo anterior
+        con.execute("DELETE FROM movimentacoes WHERE item_nome = 'A' AND tipo = 'Devolucao'")
+        con.commit()
+        confere()
+        # exclusão de um movimento que não é o último: nada muda
+        con.execute("DELETE FROM movimentacoes WHERE item_nome = 'C' AND aluno_nome = 'Duda'")
+        con.commit()
+        confere()
+        # edição do timestamp: o empréstimo de B passa a ser o mais recente
+        con.execute("UPDATE movimentacoes SET timestamp = '2024-01-05T10:00:00' "
+                    "WHERE item_nome = 'B' AND tipo = 'Emprestimo'")
+        con.commit()
+        confere()
+        # renomear o item do último movimento de C para B
+        con.execute("UPDATE movimentacoes SET item_nome = 'B', timestamp = '2024-01-06T10:00:00' "
+                    "WHERE item_nome = 'C'")
+        con.commit()
+        confere()
+    finally:
+        con.close()
+    assert set(app.status_itens()["item_nome"]) == {"A", "B"}
+
+
+def test_export_periodo_limites_e_timestamp_antigo(tmp_path, monkeypatch):
+    app = _carrega_app(tmp_path, monkeypatch)
+    tss = ["2023-12-31T23:59:59", "2024-01-01T00:00:00", "2024-01-01T12:00:00", "2024-01-01T23:59:59",
+           "2024-01-01T23:59:59.5", "2024-01-02T00:00:00",
+           # formato antigo que o strftime do SQLite não entende (ts_us NULL)
+           "2024-01-01T10:00:00-0300", "2023-12-31T10:00:00-0300"]
+    app.inserir_movimentos_bulk([{**_emprestimo(i), "timestamp": ts} for i, ts in enumerate(tss)])
+    # limites como a tela de exportação monta (dia inteiro, até 23:59:59.999999)
+    dia = date(2024, 1, 1)
+    ini = datetime.combine(dia, datetime.min.time()).isoformat()
+    fim = datetime.combine(dia, datetime.max.time()).isoformat()
+    sql, params = app.sql_export_movimentos(["timestamp"], ini, fim)
+    with app.conn_leitura() as con:
+        obtidos = [r[0] for r in con.execute(sql, params)]
+    assert obtidos == ["2024-01-01T10:00:00-0300", "2024-01-01T00:00:00", "2024-01-01T12:00:00",
+                       "2024-01-01T23:59:59", "2024-01-01T23:59:59.5"]
+
+
+def test_devolucao_em_lote_do_beneficiario(tmp_path, monkeypatch):
+    app = _carrega_app(tmp_path, monkeypatch)
+    def emp(item, qtd, aluno):
+        return {**_emprestimo(0), "item_nome": item, "quantidade": qtd, "beneficiario_tipo": "aluno",
+                "beneficiario_nome": "", "aluno_nome": aluno, "aluno_sobrenome": "S", "aluno_serie": "5A"}
+    ids = app.inserir_movimento([emp("A", 2, "Ana"), emp("B", 3, "Ana"), emp("C", 1, "Bia")])
+    # devolução parcial do empréstimo de B: fica 1 pendente
+    app.inserir_movimento({**emp("B", 2, "Ana"), "tipo": "Devolucao", "loan_id": ids[1]})
+    pend = app.emprestimos_pendentes_df().to_dict("records")
+    sel = next(r for r in pend if r["item_nome"] == "A")
+    lote = app.devolucoes_do_beneficiario(pend, sel, "lote")
+    app.inserir_movimento(lote)
+
+    con = sqlite3.connect(tmp_path / "sala_leitura.db")
+    try:
+        devs = con.execute("SELECT loan_id, quantidade, observacoes FROM movimentacoes "
+                           "WHERE tipo = 'Devolucao' AND observacoes = 'lote' ORDER BY loan_id").fetchall()
+    finally:
+        con.close()
+    assert devs == [(ids[0], 2, "lote"), (ids[1], 1, "lote")]
+    # só o empréstimo da outra aluna continua pendente
+    assert app.emprestimos_pendentes_df()["loan_id"].tolist() == [ids[2]]
+
+
+def test_pool_de_leitura_limitado(tmp_path, monkeypatch):
+    app = _carrega_app(tmp_path, monkeypatch)
+    n = app.POOL_LEITURA + 2
+    abertas = []
+    with ExitStack() as pilha:
+        for _ in range(n):
+            abertas.append(pilha.enter_context(app.conn_leitura()))
+        assert len({id(c) for c in abertas}) == n
+    # só POOL_LEITURA voltam ao pool; as demais são fechadas
+    assert app._conns_leitura().qsize() == app.POOL_LEITURA
+    fechadas = 0
+    for con in abertas:
+        try:
+            con.execute("SELECT 1")
+        except sqlite3.ProgrammingError:
+            fechadas += 1
+    assert fechadas == n - app.POOL_LEITURA
+    with app.conn_leitura() as con:
+        assert con.execute("SELECT COUNT(*) FROM movimentacoes").fetchone() == (0,)